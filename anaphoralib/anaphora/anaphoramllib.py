@@ -1,4 +1,3 @@
-#!/usr/bin/python2.7
 # -!- coding: utf-8 -!-
 # usage: anaphoramllib.py
 
@@ -6,15 +5,24 @@ from __future__ import unicode_literals
 
 import os
 import random
-import cPickle as pickle
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import numpy as np
 
+from .. import persistence
 from ..tagsets import utils
 
 class AnaphoraResolutor(object):
     """
     Base class for Anaphora resolution
     """
+    WINDOW_BEFORE = 24
+    """Number of groups before an anaphor where antecedents are looked for"""
+    WINDOW_AFTER = 9
+    """Number of groups after an anaphor where antecedents are looked for"""
+
     def __init__(self, tagset):
         self.tagset = tagset
 
@@ -25,32 +33,70 @@ class AnaphoraResolutor(object):
             u'себя', u'свой'
         }
 
-        return group.lemma in pronouns
+        return len(group.lemma) == 1 and group.lemma[0] in pronouns
 
-    def get_antecedent(self, group, groups):
+    def get_antecedent(self, group, groups, position=None, candidates=None):
         return None
 
     def group_fits(self, group, target_group):
         return True
 
-    def iterate_possible_antecedents(self, target_group, groups):
-        return sorted([group for group in groups
-                       if -10 < groups.index(target_group) - groups.index(group) < 25 and
-                             group.offset != target_group.offset and
-                              (self.tagset.pos_filters['noun'](group) or self.tagset.pos_filters['pronoun'](group))
-                             and self.group_fits(group, target_group)],
-                             key=lambda x: x.offset, reverse=True)
+    def candidate_mask(self, groups):
+        """
+        Marks groups that may be antecedents (nouns and pronouns), compute it once for a document
+        and pass to iterate_possible_antecedents or get_antecedent
+        :return: a boolean array with a value for each group
+        """
+        return np.array([bool(self.tagset.pos_filters['noun'](group) or self.tagset.pos_filters['pronoun'](group))
+                         for group in groups], dtype=bool)
+
+    def iterate_possible_antecedent_positions(self, target_group, groups, position=None, candidates=None):
+        """
+        Finds positions of possible antecedents of a group in a window around it
+        :param position: a position of target_group in groups (found with groups.index if not provided)
+        :param candidates: a result of candidate_mask(groups) (computed if not provided)
+        :return: a list of positions of possible antecedents, the closest preceding ones first
+        """
+        if position is None:
+            position = groups.index(target_group)
+        if candidates is None:
+            candidates = self.candidate_mask(groups)
+
+        start = max(0, position - self.WINDOW_BEFORE)
+        end = min(len(groups), position + self.WINDOW_AFTER + 1)
+
+        window = [i for i in np.flatnonzero(candidates[start:end]) + start
+                  if groups[i].offset != target_group.offset and self.group_fits(groups[i], target_group)]
+        return sorted(window, key=lambda i: groups[i].offset, reverse=True)
+
+    def iterate_possible_antecedents(self, target_group, groups, position=None, candidates=None):
+        return [groups[i] for i in self.iterate_possible_antecedent_positions(target_group, groups,
+                                                                               position, candidates)]
+
+    def resolve_all(self, groups):
+        """
+        Finds antecedents of all anaphors of a document
+        :return: a dict mapping positions of anaphors in groups to their antecedents (or None)
+        """
+        candidates = self.candidate_mask(groups)
+        return {position: self.get_antecedent(group, groups, position, candidates)
+                for position, group in enumerate(groups) if self.is_anaphor(group)}
 
 # Base class for ML-based approaches
 # To create non-abstract resolutor class, one could only override get_feature_vector function
 # (See BasicAnaphoraMLResolutor as an example)
-# For more elaborate implementations, iterate_possible_antecedents could also be overridden to filter more precisely
+# For more elaborate implementations, iterate_possible_antecedent_positions could also be overridden to filter more precisely
 
 class AnaphoraMLResolutor(AnaphoraResolutor):
-    def __init__(self, tagset):
+    def __init__(self, tagset, ranking=False):
+        """
+        :param ranking: if True, all candidates of an anaphor are scored with predict_proba and the most probable
+        one is chosen, otherwise the closest candidate classified as an antecedent is chosen
+        """
         super(AnaphoraMLResolutor, self).__init__(tagset)
         self.model = None
         self.trained = False
+        self.ranking = ranking
 
     def train_model(self, clf_object, data):
         """
@@ -66,52 +112,128 @@ class AnaphoraMLResolutor(AnaphoraResolutor):
         for position in data:
             n_antecedent, candidates, n_anaphora, groups = position
 
-            candidates = random.sample(xrange(len(candidates)), len(candidates) / 2)
+            candidates = random.sample(range(len(candidates)), len(candidates) // 2)
             if not n_antecedent in candidates:
                 candidates.append(n_antecedent)
 
-            y_data = [1 if i==n_antecedent else 0 for i in candidates]
+            train_x.append(self.get_feature_matrix(candidates, n_anaphora, groups))
+            train_y.append(np.array(candidates) == n_antecedent)
 
-            train_x.extend(self.get_feature_vector(i, n_anaphora, groups) for i in candidates)
-            train_y.extend(y_data)
-
-        self.model.fit(np.asarray(train_x), np.asarray(train_y))
+        self.model.fit(np.vstack(train_x), np.concatenate(train_y).astype(int))
         self.trained = True
 
 
-    def load_model(self, filename):
-        if os.path.exists(filename):
-            with open(filename, 'rb') as inp_file:
+    def load_model(self, path, lazy=True):
+        """
+        Loads a model saved with save_model (a directory) or a pickled model saved by older versions (a file).
+        Arrays of a model are memory-mapped, so processes that load the same model share them
+        :param lazy: if True, the model is loaded on the first use
+        """
+        if os.path.isdir(path):
+            header = persistence.read_header(path)
+            tagset = header['metadata'].get('tagset')
+            if tagset is not None and tagset != self.tagset.__name__:
+                raise ValueError('The model was trained with another tagset: {}'.format(tagset))
+            self.model = persistence.load_model(path, lazy=lazy)
+            self.trained = True
+        elif os.path.exists(path):
+            with open(path, 'rb') as inp_file:
                 self.model = pickle.load(inp_file)
             self.trained = True
 
-    def save_model(self, filename):
+    def save_model(self, path):
+        """
+        Saves the model to a directory (see anaphoralib.persistence), which is created if it does not exist.
+        Older versions pickled the model to a single file; such files can still be loaded with load_model,
+        but a path to a file (e.g. model.pkl) now becomes a directory with a header and array files
+        """
         if self.model:
-            with(open(filename, 'wb')) as inp_file:
-                pickle.dump(self.model, inp_file)
+            persistence.save_model(self.model, path, metadata={'resolutor': self.__class__.__name__,
+                                                               'tagset': self.tagset.__name__,
+                                                               'ranking': self.ranking})
 
     def get_feature_vector(self, n_antecedent, n_anaphora, groups):
         return []
 
-    def get_antecedent(self, target_group, groups):
+    def get_feature_matrix(self, n_antecedents, n_anaphora, groups):
+        """
+        Returns feature vectors of several candidates of an anaphor as a matrix (one row for each candidate).
+        By default calls get_feature_vector for every candidate, override it to compute features at once
+        """
+        return np.array([self.get_feature_vector(i, n_anaphora, groups) for i in n_antecedents], dtype=float)
+
+    def choose_antecedents(self, x_data, bounds):
+        """
+        Chooses antecedents with a single call of the model for candidates of several anaphors
+        :param x_data: a feature matrix of candidates of all anaphors
+        :param bounds: rows of candidates of the i-th anaphor are bounds[i]:bounds[i + 1]
+        :return: an index of the chosen candidate (among candidates of an anaphor) or None for each anaphor
+        """
+        if self.ranking:
+            scores = self.model.predict_proba(x_data)[:, -1] if len(x_data) else np.zeros(0)
+        else:
+            scores = np.asarray(self.model.predict(x_data)) if len(x_data) else np.zeros(0)
+
+        chosen = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if start == end:
+                chosen.append(None)
+            elif self.ranking:
+                chosen.append(int(np.argmax(scores[start:end])))
+            else:
+                positive = np.flatnonzero(scores[start:end])
+                chosen.append(int(positive[0]) if len(positive) else None)
+        return chosen
+
+    def get_antecedent(self, target_group, groups, position=None, candidates=None):
         if self.model and self.trained:
-            for group in self.iterate_possible_antecedents(target_group, groups):
-                if self.model.predict(self.get_feature_vector(groups.index(group), groups.index(target_group), groups))[0]:
-                    return group
+            if position is None:
+                position = groups.index(target_group)
+            antecedents = self.iterate_possible_antecedent_positions(target_group, groups, position, candidates)
+            if antecedents:
+                chosen = self.choose_antecedents(self.get_feature_matrix(antecedents, position, groups),
+                                                 [0, len(antecedents)])[0]
+                if chosen is not None:
+                    return groups[antecedents[chosen]]
 
         return None
 
+    def resolve_all(self, groups):
+        """
+        Finds antecedents of all anaphors of a document with a single call of the model
+        :return: a dict mapping positions of anaphors in groups to their antecedents (or None)
+        """
+        positions = [position for position, group in enumerate(groups) if self.is_anaphor(group)]
+        if not self.model or not self.trained:
+            return {position: None for position in positions}
+
+        candidates = self.candidate_mask(groups)
+        antecedents = [self.iterate_possible_antecedent_positions(groups[position], groups, position, candidates)
+                       for position in positions]
+        bounds = np.cumsum([0] + [len(position_antecedents) for position_antecedents in antecedents])
+
+        x_data = [self.get_feature_matrix(position_antecedents, position, groups)
+                  for position, position_antecedents in zip(positions, antecedents) if position_antecedents]
+        chosen = self.choose_antecedents(np.vstack(x_data) if x_data else np.zeros((0, 0)), bounds)
+
+        return {position: groups[position_antecedents[i]] if i is not None else None
+                for position, position_antecedents, i in zip(positions, antecedents, chosen)}
+
 class BasicAnaphoraMLResolutor(AnaphoraMLResolutor):
     def get_feature_vector(self, n_antecedent, n_anaphora, groups):
         return [groups[n_anaphora].offset - groups[n_antecedent].offset]
 
+    def get_feature_matrix(self, n_antecedents, n_anaphora, groups):
+        offsets = np.array([groups[i].offset for i in n_antecedents], dtype=float)
+        return (groups[n_anaphora].offset - offsets).reshape(-1, 1)
+
 # Dummy resolutors for using as a baseline
 class AnaphoraDummyResolutor(AnaphoraResolutor):
     def group_fits(self, potential_antecedent, anaphor):
         return True
 
-    def get_antecedent(self, target_group, groups):
-        antecedents = self.iterate_possible_antecedents(target_group, groups)
+    def get_antecedent(self, target_group, groups, position=None, candidates=None):
+        antecedents = self.iterate_possible_antecedents(target_group, groups, position, candidates)
         return antecedents[0] if len(antecedents) > 0 else None
 
 class AnaphoraAgrResolutor(AnaphoraDummyResolutor):
@@ -3,10 +3,21 @@ from __future__ import unicode_literals
 import collections
 import os
 import codecs
-import subprocess
-import re
+import json
+import pickle
+import math
+import types
+import importlib
+import multiprocessing
 
+import numpy as np
+from future.utils import string_types
+
+from .. import scorer
 from .. import utils
+from . import columnar
+
+SNAPSHOT_VERSION = 1
 
 
 class Corpus(object):
@@ -18,6 +29,8 @@ class Corpus(object):
         self.gs = []
         self.doc_ids = []
         self.parses = None
+        self.vocabularies = None
+        """Vocabularies shared by texts if they are stored in a columnar format (see corpora.columnar)"""
 
         self.groups = []
         self.mentions = []
@@ -55,37 +68,238 @@ class Corpus(object):
     def load_gs(self, filename):
         pass
 
-    def find_groups(self, use_parses=True):
+    def find_groups(self, use_parses=True, n_jobs=1, compact=False):
         """Fills two class attributes: groups and mentions with lists of all groups and mentions
-        (groups that are nouns or pronouns) in texts"""
+        (groups that are nouns or pronouns) in texts
+        :param n_jobs: number of processes to use (-1 means all CPUs), texts are processed in chunks
+        and results keep the order of texts
+        :param compact: if True, groups are stored as utils.SpanGroup objects that refer to words of texts"""
         if self.texts_loaded():
-            parses = self.parses if self.parses and use_parses else False
-            self.groups = [utils.find_groups(text,
-                                             self.tagset, parses) for i, text in enumerate(self.texts)]
-            self.mentions = [utils.find_mentions(text, self.tagset) for text in self.texts]
+            parses = self.parses if self.parses and use_parses else None
+            if n_jobs == 1:
+                self.groups = [utils.find_groups(text, self.tagset, parses[i] if parses else None, compact=compact)
+                               for i, text in enumerate(self.texts)]
+                self.mentions = [utils.find_mentions(text, self.tagset) for text in self.texts]
+            else:
+                tagset = _tagset_reference(self.tagset)
+                results = _map_chunks(_find_groups_worker,
+                                      [(tagset, text, parses[i] if parses else None)
+                                       for i, text in enumerate(self.texts)],
+                                      n_jobs)
+
+                self.groups = [[_decode_group(self.texts[i], *group, compact=compact) for group in groups]
+                               for i, (groups, _) in enumerate(results)]
+                self.mentions = [[self.texts[i][j] for j in mentions] for i, (_, mentions) in enumerate(results)]
             self.groups_loaded_ = True
 
-    def create_indices(self):
-        """Creates indices that are not corpus-specific"""
+    def create_indices(self, n_jobs=1):
+        """Creates indices that are not corpus-specific
+        :param n_jobs: number of processes to use (-1 means all CPUs)"""
         self.heads_index = []
         self.words_index = []
         self.mentions_index = []
 
-        for i, text in enumerate(self.texts):
-            self.heads_index.append({})
-            self.words_index.append({w.offset: j for j, w in enumerate(text)})
+        if n_jobs == 1:
+            for i, text in enumerate(self.texts):
+                if not self.groups_loaded_:
+                    self.mentions.append(utils.find_mentions(text, self.tagset))
+
+                heads_index, words_index, mentions_index = _create_text_indices(
+                    text, self.groups[i] if self.groups_loaded_ else None, self.mentions[i])
+                self.heads_index.append(heads_index)
+                self.words_index.append(words_index)
+                self.mentions_index.append(mentions_index)
+            return
 
-            if not self.groups_loaded_:
-                self.mentions.append(utils.find_mentions(text, self.tagset))
-            self.mentions_index.append({mention.offset: j for j, mention in enumerate(self.mentions[i])})
+        tagset = _tagset_reference(self.tagset)
+        results = _map_chunks(_create_indices_worker,
+                              [(tagset,
+                                text,
+                                self.groups[i] if self.groups_loaded_ else None,
+                                None if not self.groups_loaded_ else self.mentions[i])
+                               for i, text in enumerate(self.texts)],
+                              n_jobs)
+
+        for i, (heads_index, words_index, mentions, mentions_index) in enumerate(results):
+            if mentions is not None:
+                self.mentions.append([self.texts[i][j] for j in mentions])
+            self.heads_index.append({offset: self.groups[i][j] if j >= 0 else self.texts[i][-j - 1]
+                                     for offset, j in heads_index.items()})
+            self.words_index.append(words_index)
+            self.mentions_index.append(mentions_index)
+
+    def save_snapshot(self, path):
+        """
+        Saves loaded texts, parses, GS, groups, mentions and indices to a folder, so that they
+        could be loaded with load_snapshot() without parsing the corpus files again.
+        Token and group data is stored in .npy files that are memory-mapped when loading
+        """
+        if os.path.exists(path) and not os.path.isdir(path):
+            raise AttributeError('Provided path ({}) is not a folder'.format(path))
+        if not os.path.exists(path):
+            os.mkdir(path)
+
+        vocabularies = self.vocabularies if self.vocabularies else columnar.Vocabularies()
+        texts = [text if isinstance(text, columnar.ColumnarText)
+                 else columnar.ColumnarText.from_words(text, vocabularies, self.parses[i] if self.parses else None)
+                 for i, text in enumerate(self.texts)]
+
+        arrays = {'text_bounds': _bounds(len(text) for text in texts)}
+        for column in columnar.ColumnarText.columns:
+            if column in ('heads', 'rel_ids') and not self.parses:
+                continue
+            arrays[column] = _concatenate([getattr(text, column) for text in texts])
+
+        group_tags = columnar.Vocabulary()
+        group_types = columnar.Vocabulary()
+
+        if self.groups_loaded_:
+            encoded_groups = []
+            for i, text in enumerate(self.texts):
+                words_positions = _words_positions(text)
+                encoded_groups.append([(group_tags.add(tag), head, group_types.add(group_type), words)
+                                       for tag, head, group_type, words in
+                                       (_encode_group(group, words_positions) for group in self.groups[i])])
+
+            arrays['group_bounds'] = _bounds(len(groups) for groups in encoded_groups)
+            doc_groups = [group for groups in encoded_groups for group in groups]
+            arrays['group_tag_ids'] = np.array([group[0] for group in doc_groups], dtype=np.int32)
+            arrays['group_heads'] = np.array([group[1] for group in doc_groups], dtype=np.int32)
+            arrays['group_type_ids'] = np.array([group[2] for group in doc_groups], dtype=np.int32)
+            arrays['group_word_bounds'] = _bounds(len(group[3]) for group in doc_groups)
+            arrays['group_words'] = np.array([j for group in doc_groups for j in group[3]], dtype=np.int32)
+
+        # heads index refers either to a group of a text (non-negative values) or to a word (negative values)
+        heads_index = []
+        for i, text_heads_index in enumerate(self.heads_index):
+            heads_index.append(_encode_heads_index(text_heads_index, self.texts[i],
+                                                   self.groups[i] if self.groups_loaded_ else []))
+
+        mentions = []
+        for i, text in enumerate(self.texts[:len(self.mentions)]):
+            words_positions = _words_positions(text)
+            mentions.append([words_positions[mention] for mention in self.mentions[i]])
+        arrays['mention_bounds'] = _bounds(len(text_mentions) for text_mentions in mentions)
+        arrays['mentions'] = np.array([j for text_mentions in mentions for j in text_mentions], dtype=np.int32)
+
+        for name in arrays:
+            np.save(os.path.join(path, name + '.npy'), arrays[name])
+
+        with open(os.path.join(path, 'annotation.pickle'), 'wb') as out_file:
+            pickle.dump({'gs': self.gs,
+                         'gs_doc_ids': getattr(self, 'gs_doc_ids', None),
+                         'words_index': self.words_index,
+                         'mentions_index': self.mentions_index,
+                         'heads_index': heads_index,
+                         'chains_index': self.chains_index,
+                         'gs_mapping': self.gs_mapping,
+                         'gs_index': self.gs_index,
+                         'n_errors': dict(self.n_errors)}, out_file, protocol=2)
+
+        with codecs.open(os.path.join(path, 'vocabularies.json'), 'w', encoding='utf-8') as out_file:
+            json.dump({'wordforms': vocabularies.wordforms.items,
+                       'lemmas': vocabularies.lemmas.items,
+                       'tags': vocabularies.tags.items,
+                       'rels': vocabularies.rels.items,
+                       'group_tags': group_tags.items,
+                       'group_types': group_types.items}, out_file)
+
+        with codecs.open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as out_file:
+            json.dump({'version': SNAPSHOT_VERSION,
+                       'class': self.__class__.__name__,
+                       'tagset': getattr(self.tagset, '__name__', None),
+                       'doc_ids': self.doc_ids,
+                       'syntax': bool(self.parses),
+                       'texts_loaded': self.texts_loaded_,
+                       'gs_loaded': self.gs_loaded_,
+                       'groups_loaded': self.groups_loaded_}, out_file)
+
+    def load_snapshot(self, path, mmap=True, compact=False):
+        """
+        Loads a corpus saved with save_snapshot(). Texts are loaded as columnar.ColumnarText objects,
+        groups and mentions of a text are created when the text is accessed for the first time
+        :param mmap: if True, token and group arrays are memory-mapped (and shared between processes
+        that load the same snapshot) instead of being read into memory
+        :param compact: if True, groups are loaded as utils.SpanGroup objects
+        """
+        with codecs.open(os.path.join(path, 'meta.json'), encoding='utf-8') as inp_file:
+            meta = json.load(inp_file)
+        if meta['version'] != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version: {} (expected {})'.format(meta['version'],
+                                                                                   SNAPSHOT_VERSION))
+        if meta['tagset'] and meta['tagset'] != getattr(self.tagset, '__name__', meta['tagset']):
+            raise ValueError('Snapshot was created with a different tagset: {}'.format(meta['tagset']))
+
+        with codecs.open(os.path.join(path, 'vocabularies.json'), encoding='utf-8') as inp_file:
+            items = json.load(inp_file)
+        self.vocabularies = columnar.Vocabularies()
+        for name in ('wordforms', 'lemmas', 'tags', 'rels'):
+            setattr(self.vocabularies, name, columnar.Vocabulary(items[name]))
+        group_tags = items['group_tags']
+        group_types = items['group_types']
+
+        with open(os.path.join(path, 'annotation.pickle'), 'rb') as inp_file:
+            annotation = pickle.load(inp_file)
+
+        load_array = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None)
+        text_bounds = load_array('text_bounds')
+        columns = {column: load_array(column) for column in columnar.ColumnarText.columns
+                   if meta['syntax'] or column not in ('heads', 'rel_ids')}
+
+        self.doc_ids = meta['doc_ids']
+        self.texts = [columnar.ColumnarText(self.vocabularies,
+                                            **{column: columns[column][text_bounds[i]:text_bounds[i + 1]]
+                                               for column in columns})
+                      for i in range(len(text_bounds) - 1)]
+        self.parses = [text.parse for text in self.texts] if meta['syntax'] else None
+
+        self.gs = annotation['gs']
+        if annotation['gs_doc_ids'] is not None:
+            self.gs_doc_ids = annotation['gs_doc_ids']
+        self.words_index = annotation['words_index']
+        self.mentions_index = annotation['mentions_index']
+        self.chains_index = annotation['chains_index']
+        self.gs_mapping = annotation['gs_mapping']
+        self.gs_index = annotation['gs_index']
+        self.n_errors = collections.defaultdict(int, annotation['n_errors'])
+
+        mention_bounds = load_array('mention_bounds')
+        mentions = load_array('mentions')
+        self.mentions = _LazyList(len(mention_bounds) - 1,
+                                  lambda i: [self.texts[i][j] for j in mentions[mention_bounds[i]:mention_bounds[i + 1]]])
 
-            if self.groups_loaded_:
-                for group in self.groups[i]:
-                    for g in group.iter_groups():
-                        head_offset = g.head_offset()
-                        if head_offset not in self.heads_index[-1] \
-                                or len(g.lemma) > len(self.heads_index[-1][head_offset].lemma):
-                            self.heads_index[-1][head_offset] = g
+        self.groups = []
+        self.heads_index = annotation['heads_index']
+        if meta['groups_loaded']:
+            group_bounds = load_array('group_bounds')
+            group_arrays = {name: load_array(name) for name in ('group_tag_ids', 'group_heads', 'group_type_ids',
+                                                                 'group_word_bounds', 'group_words')}
+
+            def load_groups(i):
+                text = self.texts[i]
+                groups = []
+                for j in range(group_bounds[i], group_bounds[i + 1]):
+                    words = group_arrays['group_words'][group_arrays['group_word_bounds'][j]:
+                                                        group_arrays['group_word_bounds'][j + 1]]
+                    groups.append(_decode_group(text,
+                                                group_tags[group_arrays['group_tag_ids'][j]],
+                                                int(group_arrays['group_heads'][j]),
+                                                group_types[group_arrays['group_type_ids'][j]],
+                                                words,
+                                                compact))
+                return groups
+
+            def load_heads_index(i):
+                groups = self.groups[i]
+                return {offset: groups[j] if j >= 0 else self.texts[i][-j - 1]
+                        for offset, j in annotation['heads_index'][i].items()}
+
+            self.groups = _LazyList(len(group_bounds) - 1, load_groups)
+            self.heads_index = _LazyList(len(annotation['heads_index']), load_heads_index)
+
+        self.texts_loaded_ = meta['texts_loaded']
+        self.gs_loaded_ = meta['gs_loaded']
+        self.groups_loaded_ = meta['groups_loaded']
 
     def gs_loaded(self):
         return self.gs_loaded_
@@ -108,9 +322,11 @@ class Corpus(object):
                                                                 n_chains=n_chains,
                                                                 n_words=n_words))
 
-    def export_conll(self, filename, groups=None, chains=None):
-        """Saves the corpus annotation in the CONLL-2012 shared task format"""
-        self.create_indices()  # just in case there are no words index yet
+    def export_conll(self, filename, groups=None, chains=None, update_indices=True):
+        """Saves the corpus annotation in the CONLL-2012 shared task format
+        :param update_indices: if False, indices are not recreated before exporting (they should be created already)"""
+        if update_indices:
+            self.create_indices()  # just in case there are no words index yet
         if not groups:
             groups = [text['groups'] for text in self.gs]
 
@@ -278,44 +494,189 @@ class Corpus(object):
             return False
 
     def score_coreference(self, groups, chains, metric='all',
-                          scorer_path='scorer.pl', perl_path='perl', heads_only=False):
+                          scorer_path=None, perl_path='perl', heads_only=False):
+        """
+        Scores coreference chains against GS
+        :param groups: a list of dicts with groups (with tokens_shifts) for every text
+        :param chains: a list of dicts with chains (lists of group ids) for every text
+        :param metric: 'all', a name of a metric or a list of names (see anaphoralib.scorer.METRICS)
+        :param scorer_path: a path to the CoNLL reference scorer (scorer.pl); if None, the built-in
+        scorer (anaphoralib.scorer) is used, which is much faster and does not need perl
+        :param heads_only: if True, GS groups are reduced to their heads
+        :return: a dict mapping each metric to a dict {score name: (recall, precision, f1)}
+        """
+        gs_groups = self._gs_heads() if heads_only else [text_gs['groups'] for text_gs in self.gs]
+        gs_chains = [text_gs['chains'] for text_gs in self.gs]
+
+        if scorer_path is None:
+            return scorer.score([scorer.get_clusters(gs_groups[i], gs_chains[i]) for i in range(len(self.gs))],
+                                [scorer.get_clusters(groups[i], chains[i]) for i in range(len(self.gs))],
+                                metric)
+
         tmp_file_gold = 'tmp_score_rucor_gold.txt'
         tmp_file_test = 'tmp_score_rucor_test.txt'
 
-        rx_metric = re.compile('METRIC ([a-z]+):')
-        rx_score = re.compile('([A-Za-z\- ]+): Recall:.* ([0-9\.]+)%\tPrecision:.* ([0-9\.]+)%\tF1:.* ([0-9\.]+)%')
-
-        scorer_params = [perl_path,
-                         scorer_path,
-                         metric,
-                         tmp_file_gold,
-                         tmp_file_test,
-                         'none']
         if heads_only:
-            gs_heads = [{group_id:
-                                 {
-                                     'parent': text_gs['groups'][group_id]['parent'],
-                                     'tokens_shifts': [text_gs['groups'][group_id]['head_shift'][0]]
-                                 } for group_id in text_gs['groups']} for text_gs in self.gs]
-
-            self.export_conll(tmp_file_gold, groups=gs_heads, chains=[gs['chains'] for gs in self.gs])
+            self.export_conll(tmp_file_gold, groups=gs_groups, chains=gs_chains)
         else:
             self.export_conll(tmp_file_gold)
         self.export_conll(tmp_file_test, groups=groups, chains=chains)
 
-        output = subprocess.check_output(scorer_params).decode('utf-8').split('\n')
+        return scorer.run_reference_scorer(tmp_file_gold, tmp_file_test, metric, scorer_path, perl_path)
+
+    def _gs_heads(self):
+        """Returns GS groups reduced to their first heads"""
+        return [{group_id:
+                     {
+                         'parent': text_gs['groups'][group_id]['parent'],
+                         'tokens_shifts': [text_gs['groups'][group_id]['head_shift'][0]]
+                     } for group_id in text_gs['groups']} for text_gs in self.gs]
+
+
+class _LazyList(object):
+    """A read-only list which items are created on the first access"""
+    def __init__(self, length, load_item):
+        self.items = [None] * length
+        self.loaded = [False] * length
+        self.load_item = load_item
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if not self.loaded[i]:
+            self.items[i] = self.load_item(i % len(self))
+            self.loaded[i] = True
+        return self.items[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, item):
+        self.items.append(item)
+        self.loaded.append(True)
+
+
+def _bounds(lengths):
+    return np.cumsum([0] + list(lengths), dtype=np.int64)
+
+
+def _concatenate(arrays):
+    return np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int32)
+
+
+def _words_positions(text):
+    """Maps each word of a text to its index"""
+    return {word: j for j, word in enumerate(text)}
+
+
+def _encode_group(group, words_positions):
+    """Represents a group (or a word) as a tuple (tag, head, type, indices of its words in a text)"""
+    words = group.words if group.type != 'word' else [group]
+    return group.tag, group.head, group.type, [words_positions[word] for word in words]
+
+
+def _encode_heads_index(heads_index, text, groups):
+    """Replaces groups in a heads index with their indices (non-negative values) and words with
+    negative values (-index - 1)"""
+    words_positions = _words_positions(text)
+    groups_positions = {id(group): j for j, group in enumerate(groups)}
+    return {offset: groups_positions[id(g)] if id(g) in groups_positions else -words_positions[g] - 1
+            for offset, g in heads_index.items()}
+
+
+def _create_text_indices(text, groups, mentions):
+    """Returns a heads index, a words index and a mentions index of a text (see Corpus.__init__)"""
+    heads_index = {}
+    words_index = {w.offset: j for j, w in enumerate(text)}
+    mentions_index = {mention.offset: j for j, mention in enumerate(mentions)}
+
+    for group in groups or []:
+        for g in group.iter_groups():
+            head_offset = g.head_offset()
+            if head_offset not in heads_index or len(g.lemma) > len(heads_index[head_offset].lemma):
+                heads_index[head_offset] = g
+
+    return heads_index, words_index, mentions_index
+
+
+def _tagset_reference(tagset):
+    """Tagsets are usually modules that could not be pickled, so they are passed to other processes by name"""
+    return tagset.__name__ if isinstance(tagset, types.ModuleType) else tagset
+
+
+def _resolve_tagset(tagset):
+    return importlib.import_module(tagset) if isinstance(tagset, string_types) else tagset
+
+
+def _find_groups_worker(docs):
+    results = []
+    for tagset, text, parse in docs:
+        tagset = _resolve_tagset(tagset)
+        words_positions = _words_positions(text)
+        groups = utils.find_groups(text, tagset, parse)
+        mentions = utils.find_mentions(text, tagset)
+        results.append(([_encode_group(group, words_positions) for group in groups],
+                        [words_positions[mention] for mention in mentions]))
+    return results
+
+
+def _create_indices_worker(docs):
+    results = []
+    for tagset, text, groups, mentions in docs:
+        words_positions = _words_positions(text)
+        found_mentions = None
+        if mentions is None:
+            mentions = utils.find_mentions(text, _resolve_tagset(tagset))
+            found_mentions = [words_positions[mention] for mention in mentions]
+
+        heads_index, words_index, mentions_index = _create_text_indices(text, groups, mentions)
+        results.append((_encode_heads_index(heads_index, text, groups or []),
+                        words_index,
+                        found_mentions,
+                        mentions_index))
+    return results
+
+
+def _map_chunks(function, items, n_jobs):
+    """
+    Applies a function to chunks of items in a pool of processes
+    :param function: a function that takes a list of items and returns a list of results
+    :return: a list of results in the order of items
+    """
+    n_jobs = multiprocessing.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+    chunk_size = max(1, int(math.ceil(len(items) / float(n_jobs * 4))))
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
 
-        #os.remove(tmp_file_gold)
-        #os.remove(tmp_file_test)
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        results = pool.map(function, chunks)
+    finally:
+        pool.close()
+        pool.join()
 
-        scores = collections.defaultdict(dict)
-        for line in output:
-            line = line.strip('\r\n')
-            m = rx_metric.match(line)
-            if m:
-                metric = m.group(1)
-            m = rx_score.match(line)
-            if m:
-                scores[metric][m.group(1)] = (m.group(2), m.group(3), m.group(4))
+    return [result for chunk in results for result in chunk]
 
-        return dict(scores)
+
+def _decode_group(text, tag, head, group_type, indices, compact=False):
+    """Creates a group (or returns a word) of a text from its encoded representation"""
+    if group_type == 'word':
+        return text[int(indices[0])]
+
+    if compact:
+        return utils.SpanGroup.from_indices(text, [int(j) for j in indices], head, tag, group_type)
+
+    words = [text[int(j)] for j in indices]
+    return utils.Group(wordform=[word.wordform[0] for word in words],
+                       lemma=[word.lemma[0] for word in words],
+                       tag=tag,
+                       tags=[word.tag for word in words],
+                       prob=1.0,
+                       offset=words[0].offset,
+                       length=words[-1].offset + words[-1].length - words[0].offset,
+                       head=head,
+                       type=group_type,
+                       words=words)
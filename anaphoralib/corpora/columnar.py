@@ -0,0 +1,227 @@
+from __future__ import unicode_literals
+from future.utils import python_2_unicode_compatible
+
+import numpy as np
+
+
+class Vocabulary(object):
+    """Interns strings (wordforms, lemmas, tags, etc.) to integer ids"""
+    def __init__(self, items=()):
+        self.items = []
+        self.index = {}
+
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        """Returns an id of an item adding it to the vocabulary if it is not there yet"""
+        item_id = self.index.get(item)
+        if item_id is None:
+            item_id = len(self.items)
+            self.index[item] = item_id
+            self.items.append(item)
+        return item_id
+
+    def get(self, item, default=-1):
+        return self.index.get(item, default)
+
+    def __getitem__(self, item_id):
+        return self.items[item_id]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.index
+
+
+class Vocabularies(object):
+    """A set of vocabularies shared by all columnar texts of a corpus"""
+    def __init__(self):
+        self.wordforms = Vocabulary()
+        self.lemmas = Vocabulary()
+        self.tags = Vocabulary()
+        self.rels = Vocabulary()
+
+
+class ColumnarText(object):
+    """
+    A text stored column-wise: every token attribute is a NumPy array, strings are stored as ids
+    in vocabularies shared by the whole corpus. Behaves as a read-only list of words: indexing returns
+    lightweight WordView objects that have the same interface as anaphoralib.utils.Word
+    """
+    columns = ('offsets', 'lengths', 'wordform_ids', 'lemma_ids', 'tag_ids', 'heads', 'rel_ids')
+
+    def __init__(self, vocabularies, offsets, lengths, wordform_ids, lemma_ids, tag_ids, heads=None, rel_ids=None):
+        self.vocabularies = vocabularies
+
+        self.offsets = offsets
+        self.lengths = lengths
+        self.wordform_ids = wordform_ids
+        self.lemma_ids = lemma_ids
+        self.tag_ids = tag_ids
+        self.heads = heads
+        self.rel_ids = rel_ids
+
+    @classmethod
+    def from_columns(cls, vocabularies, wordforms, lemmas, tags, offsets, lengths, parse=None):
+        """
+        Creates a text from lists of token attributes interning all strings in vocabularies
+        :param parse: a list of (head, rel) tuples or None if there is no syntax
+        """
+        heads = rel_ids = None
+        if parse is not None:
+            heads = np.array([head for head, rel in parse], dtype=np.int32)
+            rel_ids = np.array([vocabularies.rels.add(rel) for head, rel in parse], dtype=np.int32)
+
+        return cls(vocabularies,
+                   offsets=np.array(offsets, dtype=np.int32),
+                   lengths=np.array(lengths, dtype=np.int32),
+                   wordform_ids=np.array([vocabularies.wordforms.add(wf) for wf in wordforms], dtype=np.int32),
+                   lemma_ids=np.array([vocabularies.lemmas.add(lemma) for lemma in lemmas], dtype=np.int32),
+                   tag_ids=np.array([vocabularies.tags.add(tag) for tag in tags], dtype=np.int32),
+                   heads=heads,
+                   rel_ids=rel_ids)
+
+    @classmethod
+    def from_words(cls, words, vocabularies, parse=None):
+        """Converts a list of anaphoralib.utils.Word objects to a columnar text"""
+        return cls.from_columns(vocabularies,
+                                wordforms=[word.wordform[0] for word in words],
+                                lemmas=[word.lemma[0] for word in words],
+                                tags=[word.tag for word in words],
+                                offsets=[word.offset for word in words],
+                                lengths=[word.length for word in words],
+                                parse=parse)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [WordView(self, i) for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('word index out of range')
+        return WordView(self, item)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield WordView(self, i)
+
+    @property
+    def parse(self):
+        """A list-like view of (head, rel) tuples or None if the text has no syntax"""
+        return ColumnarParse(self) if self.heads is not None else None
+
+    def wordform(self, i):
+        return self.vocabularies.wordforms[self.wordform_ids[i]]
+
+    def lemma(self, i):
+        return self.vocabularies.lemmas[self.lemma_ids[i]]
+
+    def tag(self, i):
+        return self.vocabularies.tags[self.tag_ids[i]]
+
+    def tag_mask(self, predicate):
+        """
+        Evaluates a predicate on a tag string once per distinct tag of the text
+        :return: a boolean array with a value for every word
+        """
+        tag_ids, inverse = np.unique(self.tag_ids, return_inverse=True)
+        values = np.array([bool(predicate(self.vocabularies.tags[tag_id])) for tag_id in tag_ids], dtype=bool)
+        return values[inverse.reshape(-1)]
+
+    def filter_mask(self, word_filter):
+        """
+        Evaluates a word filter (e.g. one of tagset.pos_filters) once per distinct
+        (wordform, lemma, tag) combination of the text. Filters should not depend on offsets
+        :return: a boolean array with a value for every word
+        """
+        if not len(self):
+            return np.zeros(0, dtype=bool)
+
+        keys = np.stack((self.wordform_ids, self.lemma_ids, self.tag_ids), axis=1)
+        _, first_indices, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        values = np.array([bool(word_filter(WordView(self, i))) for i in first_indices], dtype=bool)
+        return values[inverse.reshape(-1)]
+
+
+class ColumnarParse(object):
+    """A read-only list of (head, rel) tuples backed by arrays of a ColumnarText"""
+    def __init__(self, text):
+        self.text = text
+
+    def __len__(self):
+        return len(self.text)
+
+    def __getitem__(self, i):
+        return int(self.text.heads[i]), self.text.vocabularies.rels[self.text.rel_ids[i]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+@python_2_unicode_compatible
+class WordView(object):
+    """A word of a ColumnarText, has the same interface as anaphoralib.utils.Word"""
+    __slots__ = ('text', 'index')
+
+    prob = 1.0
+    head = 0
+    n_words = 1
+    type = 'word'
+
+    def __init__(self, text, index):
+        self.text = text
+        self.index = index
+
+    @property
+    def wordform(self):
+        return [self.text.wordform(self.index)]
+
+    @property
+    def lemma(self):
+        return [self.text.lemma(self.index)]
+
+    @property
+    def tag(self):
+        return self.text.tag(self.index)
+
+    @property
+    def tags(self):
+        return [self.tag]
+
+    @property
+    def offset(self):
+        return int(self.text.offsets[self.index])
+
+    @property
+    def length(self):
+        return int(self.text.lengths[self.index])
+
+    def head_offset(self):
+        return self.offset
+
+    def iter_groups(self):
+        yield self
+
+    def __eq__(self, other):
+        return isinstance(other, WordView) and self.text is other.text and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.text), self.index))
+
+    def __str__(self):
+        return u'{wordform}:{lemma}({tag}, {offset})'.format(lemma=u' '.join(self.lemma),
+                                                             wordform=u' '.join(self.wordform),
+                                                             tag=self.tag,
+                                                             offset=self.offset)
+
+    def __repr__(self):
+        return str(self)
@@ -2,6 +2,7 @@ import codecs
 import collections
 from .. import utils
 from ..corpora import base
+from ..corpora import columnar
 
 
 class RuCorefCorpus(base.Corpus):
@@ -10,88 +11,97 @@ class RuCorefCorpus(base.Corpus):
         self.doc_ids = None
         self.gs_doc_ids = None
 
-    def load_texts(self, filename, n_files=None):
+    def load_texts(self, filename, n_files=None, columnar_texts=False):
+        """
+        Loads tokens (and parses, if there are head and rel columns) from a file
+        :param n_files: if provided, loads only first n_files documents
+        :param columnar_texts: if True, texts are stored as columnar.ColumnarText objects with
+        vocabularies shared by the whole corpus (self.vocabularies) which takes much less memory
+        """
         self.texts = []
         self.doc_ids = []
+        self.parses = None
+        self.vocabularies = columnar.Vocabularies() if columnar_texts else None
 
-        cur_doc = 0
-
-        with (codecs.open(filename, encoding='utf-8')) as inp_file:
-            fields = inp_file.readline().strip('\r\n').split('\t')
-            load_syntax = 'head' in fields and 'rel' in fields
-            if load_syntax:
-                self.parses = []
-
-            for line in inp_file:
-                word = {pair[0]: pair[1] for pair in zip(fields, line.strip('\r\n').split('\t'))}
-                if int(word['doc_id']) > cur_doc:
-                    if n_files and len(self.doc_ids) == n_files:
-                        break
-                    self.texts.append([])
-                    if load_syntax:
-                        self.parses.append([])
-                    cur_doc = int(word['doc_id'])
-                    self.doc_ids.append(cur_doc)
-                tag = word['gram']
-                if len(tag) == 1:
-                    tag += '-----'
-                self.texts[-1].append(
-                                  utils.Word(wordform=[word['token']],
-                                             lemma=[word['lemma']],
-                                             tag=tag,
-                                             prob=1.0,
-                                             offset=int(word['shift']),
-                                             length=int(word['length'])))
-                if load_syntax:
-                    self.parses[-1].append((int(word['head']), word['rel']))
+        for doc_id, text, parse in iter_texts(filename, self.vocabularies):
+            if n_files and len(self.doc_ids) == n_files:
+                break
+            if parse is not None:
+                if self.parses is None:
+                    self.parses = []
+                self.parses.append(parse)
+            self.texts.append(text)
+            self.doc_ids.append(doc_id)
 
         self.texts_loaded_ = True
 
-    def load_gs(self, filename):
-        self.gs = []
-        self.gs_doc_ids = []
-
-        cur_doc = 0
+    def load_gs(self, filename, doc_ids=None, gs_index=None):
+        """
+        Loads GS for loaded texts. Documents in a GS file may go in any order (even interleaved),
+        GS documents without loaded texts are skipped. After loading self.gs is aligned with self.doc_ids:
+        self.gs[i] is the GS of self.texts[i] (with no chains and groups if there is no GS for this text)
+        :param doc_ids: if provided, loads GS only for these documents
+        :param gs_index: an index built by build_gs_index(filename); if provided, only parts of a file
+        with the requested documents are read
+        """
+        texts_positions = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+        requested_docs = set(doc_ids) if doc_ids is not None else set(self.doc_ids)
+        found_docs = set()
 
-        with (codecs.open(filename, encoding='utf-8')) as inp_file:
-            fields = inp_file.readline().strip('\r\n').split('\t')
-            for line in inp_file:
-                word = {pair[0]: pair[1] for pair in zip(fields, line.strip('\r\n').split('\t'))}
+        self.gs = [_empty_gs() for _ in self.doc_ids]
 
-                doc_id = int(word['doc_id'])
-                group_id = int(word['group_id'])
-                chain_id = int(word['chain_id'])
+        if gs_index is not None:
+            fields = gs_index['fields']
+            with open(filename, 'rb') as inp_file:
+                for doc_id in self.doc_ids:
+                    if doc_id not in requested_docs or doc_id not in gs_index['docs']:
+                        continue
+                    found_docs.add(doc_id)
+                    for start, end in gs_index['docs'][doc_id]:
+                        inp_file.seek(start)
+                        for line in inp_file.read(end - start).decode('utf-8').splitlines():
+                            add_gs_group(self.gs[texts_positions[doc_id]], _parse_line(fields, line))
+        else:
+            with codecs.open(filename, encoding='utf-8') as inp_file:
+                fields = inp_file.readline().strip('\r\n').split('\t')
+                for line in inp_file:
+                    word = _parse_line(fields, line)
+                    doc_id = int(word['doc_id'])
+                    if doc_id not in requested_docs or doc_id not in texts_positions:
+                        continue
+                    found_docs.add(doc_id)
+                    add_gs_group(self.gs[texts_positions[doc_id]], word)
 
-                if doc_id > cur_doc:
-                    if doc_id not in self.doc_ids:
-                        break
-
-                    cur_doc = doc_id
-                    self.gs.append({'chains': collections.defaultdict(list), 'groups': collections.defaultdict(list)})
-                    self.gs_doc_ids.append(doc_id)
+        self.gs_doc_ids = [doc_id for doc_id in self.doc_ids if doc_id in found_docs]
+        self.gs_loaded_ = True
 
-                token_shifts = word['tk_shifts'].split(',')
-                tokens = word['content'].split(' ')
+    def iter_documents(self, texts_filename, gs_filename=None):
+        """
+        Reads texts and GS files document by document and yields every document as soon as it is assembled,
+        so that only one document at a time is kept in memory. Both files should be sorted by doc_id
+        (as RuCor files are); GS documents without a text are skipped
+        :param texts_filename: a path to a file with tokens (and, optionally, head and rel columns)
+        :param gs_filename: a path to a file with GS groups, if None, documents are yielded without GS
+        :return: yields dicts with doc_id, text (a list of words), parse (a list of (head, rel) tuples or None)
+        and gs (a dict with chains and groups, the same as an element of self.gs)
+        """
+        gs_docs = iter_gs(gs_filename) if gs_filename else iter([])
+        gs_doc_id, text_gs = next(gs_docs, (None, None))
 
-                head_shifts = word['hd_shifts'].split(',') if word['hd_shifts'] else token_shifts
-                head_tokens = word['head'].split(' ') if word['head'] else tokens
+        for doc_id, text, parse in iter_texts(texts_filename):
+            while gs_doc_id is not None and gs_doc_id < doc_id:
+                gs_doc_id, text_gs = next(gs_docs, (None, None))
 
-                self.gs[-1]['chains'][chain_id].append(group_id)
-                self.gs[-1]['groups'][group_id] = {
-                    'parent': int(word['link']),
-                    'tokens_shifts': [int(sh) for sh in token_shifts],
-                    'tokens_lengths': [len(tok) for tok in tokens],
-                    'length': int(word['length']),
-                    'attributes': {attr.split(':')[0]: attr.split(':')[1]
-                                   for attr in word['attributes'].split('|') if attr},
-                    'head_shift': [int(sh) for sh in head_shifts],
-                    'head_lengths': [len(tok) for tok in head_tokens]
-                }
+            if gs_doc_id == doc_id:
+                doc_gs = text_gs
+                gs_doc_id, text_gs = next(gs_docs, (None, None))
+            else:
+                doc_gs = _empty_gs()
 
-        self.gs_loaded_ = True
+            yield {'doc_id': doc_id, 'text': text, 'parse': parse, 'gs': doc_gs}
 
-    def create_indices(self):
-        super(RuCorefCorpus, self).create_indices()
+    def create_indices(self, n_jobs=1):
+        super(RuCorefCorpus, self).create_indices(n_jobs)
 
         self.gs_mapping = []
         self.gs_index = []
@@ -125,3 +135,155 @@ class RuCorefCorpus(base.Corpus):
 def get_sentence_borders(text):
     edges = [0] + [i + 1 for i in range(len(text)) if text.tag == 'SENT']
     return [(edges[i - 1], edges[i]) for i in range(len(edges))]
+
+
+def _empty_gs():
+    return {'chains': collections.defaultdict(list), 'groups': collections.defaultdict(list)}
+
+
+def iter_texts(filename, vocabularies=None):
+    """
+    Reads a RuCor tokens file lazily
+    :param filename: a path to a file with tokens (and, optionally, head and rel columns)
+    :param vocabularies: if provided, texts are created as columnar.ColumnarText objects sharing these vocabularies
+    :return: yields a tuple (doc_id, text, parse) for every document, parse is None if there is no syntax in a file
+    """
+    with (codecs.open(filename, encoding='utf-8')) as inp_file:
+        fields = inp_file.readline().strip('\r\n').split('\t')
+        load_syntax = 'head' in fields and 'rel' in fields
+
+        cur_doc = None
+        words = []
+        parse = [] if load_syntax else None
+
+        for line in inp_file:
+            word = _parse_line(fields, line)
+            doc_id = int(word['doc_id'])
+            if doc_id != cur_doc:
+                if words:
+                    yield (cur_doc, ) + _make_text(words, parse, vocabularies)
+                cur_doc = doc_id
+                words = []
+                parse = [] if load_syntax else None
+
+            words.append(_word_tuple(word))
+            if load_syntax:
+                parse.append((int(word['head']), word['rel']))
+
+        if words:
+            yield (cur_doc, ) + _make_text(words, parse, vocabularies)
+
+
+def text_from_tokens(tokens, vocabularies=None):
+    """
+    Creates a text from tokens given as dicts with the same fields as lines of a RuCor tokens file
+    (token, lemma, gram, shift, length and, optionally, head and rel)
+    :return: a tuple (text, parse), parse is None if tokens have no syntax
+    """
+    load_syntax = bool(tokens) and all('head' in token and 'rel' in token for token in tokens)
+    parse = [(int(token['head']), token['rel']) for token in tokens] if load_syntax else None
+    return _make_text([_word_tuple(token) for token in tokens], parse, vocabularies)
+
+
+def _word_tuple(word):
+    tag = word['gram']
+    if len(tag) == 1:
+        tag += '-----'
+    return word['token'], word['lemma'], tag, int(word['shift']), int(word['length'])
+
+
+def _make_text(words, parse, vocabularies):
+    if vocabularies is not None:
+        wordforms, lemmas, tags, offsets, lengths = zip(*words)
+        text = columnar.ColumnarText.from_columns(vocabularies, wordforms, lemmas, tags, offsets, lengths, parse)
+        return text, text.parse
+
+    return [utils.Word(wordform=[wordform],
+                       lemma=[lemma],
+                       tag=tag,
+                       prob=1.0,
+                       offset=offset,
+                       length=length) for wordform, lemma, tag, offset, length in words], parse
+
+
+def build_gs_index(filename):
+    """
+    Scans a GS file and builds an index for loading GS of selected documents (see RuCorefCorpus.load_gs)
+    :return: a dict with fields of a file and a dict mapping each doc_id to a list of byte ranges (start, end)
+    of a file occupied by this document
+    """
+    docs = collections.defaultdict(list)
+
+    with open(filename, 'rb') as inp_file:
+        header = inp_file.readline()
+        fields = header.decode('utf-8').strip('\r\n').split('\t')
+        doc_id_pos = fields.index('doc_id')
+
+        cur_doc = None
+        offset = len(header)
+        for line in inp_file:
+            doc_id = int(line.split(b'\t')[doc_id_pos])
+            if doc_id == cur_doc:
+                docs[doc_id][-1][1] = offset + len(line)
+            else:
+                docs[doc_id].append([offset, offset + len(line)])
+                cur_doc = doc_id
+            offset += len(line)
+
+    return {'fields': fields, 'docs': {doc_id: [tuple(span) for span in spans] for doc_id, spans in docs.items()}}
+
+
+def _parse_line(fields, line):
+    return {pair[0]: pair[1] for pair in zip(fields, line.strip('\r\n').split('\t'))}
+
+
+def iter_gs(filename):
+    """
+    Reads a RuCor GS file lazily
+    :param filename: a path to a file with GS groups
+    :return: yields a tuple (doc_id, gs) for every document, gs is a dict with chains and groups
+    """
+    with (codecs.open(filename, encoding='utf-8')) as inp_file:
+        fields = inp_file.readline().strip('\r\n').split('\t')
+
+        cur_doc = None
+        text_gs = None
+
+        for line in inp_file:
+            word = _parse_line(fields, line)
+
+            doc_id = int(word['doc_id'])
+            if doc_id != cur_doc:
+                if text_gs is not None:
+                    yield cur_doc, text_gs
+                cur_doc = doc_id
+                text_gs = _empty_gs()
+
+            add_gs_group(text_gs, word)
+
+        if text_gs is not None:
+            yield cur_doc, text_gs
+
+
+def add_gs_group(text_gs, word):
+    """Adds a group described by a line of a GS file (a dict of fields) to a GS dict of a document"""
+    group_id = int(word['group_id'])
+    chain_id = int(word['chain_id'])
+
+    token_shifts = word['tk_shifts'].split(',')
+    tokens = word['content'].split(' ')
+
+    head_shifts = word['hd_shifts'].split(',') if word['hd_shifts'] else token_shifts
+    head_tokens = word['head'].split(' ') if word['head'] else tokens
+
+    text_gs['chains'][chain_id].append(group_id)
+    text_gs['groups'][group_id] = {
+        'parent': int(word['link']),
+        'tokens_shifts': [int(sh) for sh in token_shifts],
+        'tokens_lengths': [len(tok) for tok in tokens],
+        'length': int(word['length']),
+        'attributes': {attr.split(':')[0]: attr.split(':')[1]
+                       for attr in word['attributes'].split('|') if attr},
+        'head_shift': [int(sh) for sh in head_shifts],
+        'head_lengths': [len(tok) for tok in head_tokens]
+    }
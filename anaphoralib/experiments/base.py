@@ -6,6 +6,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+from .. import persistence
+
 
 class BaseClassifier(object):
     """
@@ -72,6 +74,32 @@ class BaseClassifier(object):
 
         self.fitted_ = True
 
+    def save(self, path, tagset=None):
+        """
+        Saves the fitted classifier with names of features and classes (see anaphoralib.persistence)
+        :param tagset: a tagset used for extracting features, its name is saved in the header
+        """
+        if not self.is_fitted():
+            return
+
+        persistence.save_model(self.clf_, path, metadata={'classifier': self.__class__.__name__,
+                                                          'feature_names': list(self.feature_names_),
+                                                          'class_names': list(self.class_names_),
+                                                          'tagset': tagset.__name__ if tagset else None})
+
+    def load(self, path, lazy=True):
+        """
+        Loads a classifier saved with save(). Arrays of the classifier are memory-mapped,
+        so processes that load the same classifier share them
+        :param lazy: if True, the classifier is loaded on the first use
+        """
+        metadata = persistence.read_header(path)['metadata']
+
+        self.clf_ = persistence.load_model(path, lazy=lazy)
+        self.feature_names_ = metadata.get('feature_names', [])
+        self.class_names_ = metadata.get('class_names', [])
+        self.fitted_ = True
+
     def predict(self, x_test=None):
         if not self.is_fitted():
             return None
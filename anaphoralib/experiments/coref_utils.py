@@ -27,9 +27,10 @@ def print_chains_in_text(corpus, i_text, test_chains, gold_mentions):
         print()
 
 
-def get_score_table(clf, corpus, mentions, groups, heads_only=False):
+def get_score_table(clf, corpus, mentions, groups, heads_only=False, session=None):
     print(r'\textsc{{{}}} & '.format(clf.__class__.__name__), end='')
-    scores, _, _ = clf.score(corpus, mentions, groups, metrics=('muc', 'bcub', 'ceafm'), heads_only=heads_only)
+    scores, _, _ = clf.score(corpus, mentions, groups, metrics=('muc', 'bcub', 'ceafm'), heads_only=heads_only,
+                             session=session)
     print('${:.2f}$'.format(float(scores['muc']['Identification of Mentions'][2])), end='')
     for metric in ('muc', 'bcub'):
         print(''.join(' & ${:.2f}$'.format(float(score)) for score in scores[metric]['Coreference']), end='')
@@ -69,7 +70,19 @@ def create_gs_group(group, words, head):
                        )
 
 
-def get_gs_groups(corpus):
+def create_gs_span_group(text, indices, head_index):
+    """
+    The same as create_gs_group, but creates a compact utils.SpanGroup
+    :param indices: indices of group words in a text
+    :param head_index: index of a head word in a text
+    """
+    return utils.SpanGroup.from_indices(text, indices,
+                                        head=indices.index(head_index),
+                                        tag=text[head_index].tag,
+                                        type='group')
+
+
+def get_gs_groups(corpus, compact=False):
     groups = []
     group_ids = []
 
@@ -80,10 +93,13 @@ def get_gs_groups(corpus):
                                key=lambda g: (corpus.gs[i]['groups'][g]['head_shift'],
                                               len(corpus.gs[i]['groups'][g]['tokens_shifts']))):
             group = corpus.gs[i]['groups'][group_id]
-            words = [text[corpus.words_index[i][shift]] for shift in group['tokens_shifts']]
-            head = text[corpus.words_index[i][group['head_shift'][0]]]
-
-            groups[-1].append(create_gs_group(group, words, head))
+            if compact:
+                indices = [corpus.words_index[i][shift] for shift in group['tokens_shifts']]
+                groups[-1].append(create_gs_span_group(text, indices, corpus.words_index[i][group['head_shift'][0]]))
+            else:
+                words = [text[corpus.words_index[i][shift]] for shift in group['tokens_shifts']]
+                head = text[corpus.words_index[i][group['head_shift'][0]]]
+                groups[-1].append(create_gs_group(group, words, head))
             group_ids[-1].append(group_id)
 
     return groups, group_ids
@@ -0,0 +1,202 @@
+from __future__ import unicode_literals
+
+import collections
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+class PairFeatureStore(object):
+    """
+    Stores feature vectors of mention pairs on disk so that repeated experiments compute features only for new pairs.
+    A pair is identified by a document and spans (offset, length) of both mentions. Vectors are saved in chunks
+    (NumPy arrays of chunk_size rows) with an index mapping each pair to a chunk and a row; recently used chunks
+    are kept in memory (LRU).
+
+    Features of different classifiers or feature sets never mix: each one gets its own directory named
+    after the class of a classifier and a hash of its feature set.
+    Call flush() (or use a store as a context manager) to save newly added vectors.
+
+    A directory supports only one writer at a time: chunks are numbered by each store independently,
+    so two stores flushing to the same directory overwrite each other's chunks. Any number of stores
+    may read a directory that is not being written to
+    """
+    KEY_COLUMNS = 5
+    """doc, antecedent offset, antecedent length, anaphor offset, anaphor length"""
+
+    def __init__(self, path, classifier_name, feature_set, chunk_size=10000, cache_size=16):
+        """
+        :param path: a directory for all stores
+        :param classifier_name: a name of a classifier (e.g. its class name)
+        :param feature_set: anything JSON-serializable describing features (e.g. a list of feature names
+        and parameters); if it changes, features are computed anew
+        :param chunk_size: number of vectors in a chunk
+        :param cache_size: number of chunks kept in memory
+        """
+        self.classifier_name = classifier_name
+        self.feature_set_hash = feature_set_hash(feature_set)
+        self.path = os.path.join(path, '{}-{}'.format(classifier_name, self.feature_set_hash))
+        self.chunk_size = chunk_size
+        self.cache_size = cache_size
+
+        self.index = {}
+        """Maps a pair key to a tuple (chunk, row)"""
+        self.n_chunks = 0
+        self.n_features = None
+
+        self.pending_keys = []
+        self.pending_vectors = []
+        self.pending_index_ = {}
+        self.cache = collections.OrderedDict()
+
+        self.stats = collections.Counter()
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+            with open(os.path.join(self.path, 'meta.json'), 'w') as meta_file:
+                json.dump({'classifier': classifier_name, 'feature_set': feature_set}, meta_file)
+
+        self._load_index()
+
+    @classmethod
+    def for_classifier(cls, path, classifier, feature_set=None, **kwargs):
+        """
+        Creates a store for a classifier; if feature_set is None, feature_names_ of a classifier are used
+        """
+        if feature_set is None:
+            feature_set = list(getattr(classifier, 'feature_names_', []))
+        return cls(path, classifier.__class__.__name__, feature_set, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def __len__(self):
+        return len(self.index) + len(self.pending_keys)
+
+    def __contains__(self, key):
+        return key in self.index or key in self.pending_index_
+
+    @staticmethod
+    def pair_key(doc, pair):
+        """Returns a key of a pair (antecedent, anaphor) of mentions of a document (doc is an integer id)"""
+        return (int(doc), pair[0].offset, pair[0].length, pair[1].offset, pair[1].length)
+
+    def get(self, doc, pair):
+        """Returns a stored feature vector of a pair or None"""
+        return self._get(self.pair_key(doc, pair))
+
+    def put(self, doc, pair, vector):
+        self._put(self.pair_key(doc, pair), vector)
+
+    def get_features(self, doc, pairs, compute):
+        """
+        Returns a feature matrix for pairs of a document computing only features of unknown pairs
+        :param compute: a function that takes a list of pairs and returns a list of their feature vectors
+        :return: a NumPy array (n_pairs x n_features)
+        """
+        keys = [self.pair_key(doc, pair) for pair in pairs]
+        vectors = [self._get(key) for key in keys]
+
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            computed = list(compute([pairs[i] for i in missing]))
+            if len(computed) != len(missing):
+                raise ValueError('Expected {} feature vectors of missing pairs, got {}'.format(len(missing),
+                                                                                            len(computed)))
+            for i, vector in zip(missing, computed):
+                vector = np.asarray(vector, dtype=float)
+                self._put(keys[i], vector)
+                vectors[i] = vector
+
+        self.stats['hits'] += len(pairs) - len(missing)
+        self.stats['misses'] += len(missing)
+
+        if not vectors:
+            return np.zeros((0, self.n_features or 0))
+        return np.vstack(vectors)
+
+    def flush(self):
+        """Saves all vectors added since the last flush"""
+        while self.pending_keys:
+            self._save_chunk(self.pending_keys[:self.chunk_size], self.pending_vectors[:self.chunk_size])
+            del self.pending_keys[:self.chunk_size]
+            del self.pending_vectors[:self.chunk_size]
+        self.pending_index_ = {}
+
+    def _get(self, key):
+        position = self.index.get(key)
+        if position is not None:
+            return self._load_chunk(position[0])[position[1]]
+
+        pending_position = self.pending_index_.get(key)
+        if pending_position is not None:
+            return self.pending_vectors[pending_position]
+        return None
+
+    def _put(self, key, vector):
+        vector = np.asarray(vector, dtype=float)
+        if self.n_features is None:
+            self.n_features = len(vector)
+        elif len(vector) != self.n_features:
+            raise ValueError('Expected a vector of {} features, got {}'.format(self.n_features, len(vector)))
+
+        if key in self.index or key in self.pending_index_:
+            return
+
+        self.pending_index_[key] = len(self.pending_keys)
+        self.pending_keys.append(key)
+        self.pending_vectors.append(vector)
+
+        if len(self.pending_keys) >= self.chunk_size:
+            self.flush()
+
+    def _chunk_filename(self, chunk):
+        return os.path.join(self.path, 'chunk_{:06d}.npy'.format(chunk))
+
+    def _index_filename(self, chunk):
+        # an index of a chunk is saved after the chunk itself, so only complete chunks are loaded
+        return os.path.join(self.path, 'index_{:06d}.npy'.format(chunk))
+
+    def _load_chunk(self, chunk):
+        if chunk in self.cache:
+            vectors = self.cache.pop(chunk)
+        else:
+            vectors = np.load(self._chunk_filename(chunk))
+
+        self.cache[chunk] = vectors
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return vectors
+
+    def _save_chunk(self, keys, vectors):
+        chunk = self.n_chunks
+        np.save(self._chunk_filename(chunk), np.vstack(vectors))
+
+        chunk_index = np.zeros((len(keys), self.KEY_COLUMNS + 2), dtype=np.int64)
+        chunk_index[:, :self.KEY_COLUMNS] = keys
+        chunk_index[:, self.KEY_COLUMNS] = chunk
+        chunk_index[:, self.KEY_COLUMNS + 1] = np.arange(len(keys))
+        np.save(self._index_filename(chunk), chunk_index)
+
+        for row, key in enumerate(keys):
+            self.index[key] = (chunk, row)
+        self.n_chunks += 1
+
+    def _load_index(self):
+        while os.path.exists(self._index_filename(self.n_chunks)):
+            chunk_index = np.load(self._index_filename(self.n_chunks))
+            for row in chunk_index.tolist():
+                self.index[tuple(row[:self.KEY_COLUMNS])] = (row[self.KEY_COLUMNS], row[self.KEY_COLUMNS + 1])
+            if self.n_features is None and len(chunk_index):
+                self.n_features = np.load(self._chunk_filename(self.n_chunks), mmap_mode='r').shape[1]
+            self.n_chunks += 1
+
+
+def feature_set_hash(feature_set):
+    """Returns a short hash of a JSON-serializable description of a feature set"""
+    return hashlib.sha1(json.dumps(feature_set, sort_keys=True).encode('utf-8')).hexdigest()[:12]
@@ -1,3 +1,10 @@
+import bisect
+import collections
+import multiprocessing
+
+import numpy as np
+
+
 class DisjointSet(object):
     def __init__(self):
         self.leader = {} # maps a member to the group's leader
@@ -28,6 +35,60 @@ class DisjointSet(object):
                 self.leader[a] = self.leader[b] = a
                 self.group[a] = {a, b}
 
+
+class UnionFind(object):
+    """
+    Disjoint sets of integer ids 0..n-1 stored in arrays (with path compression and union by rank)
+    """
+    def __init__(self, n):
+        self.parent = np.arange(n)
+        self.rank = np.zeros(n, dtype=np.int8)
+
+    def find(self, a):
+        root = a
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[a] != root:
+            self.parent[a], a = root, self.parent[a]
+        return root
+
+    def union(self, a, b):
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a == root_b:
+            return
+        if self.rank[root_a] < self.rank[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        if self.rank[root_a] == self.rank[root_b]:
+            self.rank[root_a] += 1
+
+    def chains(self):
+        """
+        Returns sets with more than one element as chains: a dict mapping chain ids (starting from 1)
+        to sorted lists of ids, chains are ordered by their first elements
+        """
+        roots = np.array([self.find(a) for a in range(len(self.parent))], dtype=int)
+        members = collections.defaultdict(list)
+        for a, root in enumerate(roots):
+            members[root].append(a)
+
+        chains = [chain for chain in members.values() if len(chain) > 1]
+        return {i_chain + 1: chain for i_chain, chain in enumerate(sorted(chains))}
+
+
+def cluster_pairs(pairs, n_mentions):
+    """
+    Clusters mentions linked by pairs
+    :param pairs: an iterable of tuples of mention ids (indices in a list of mentions)
+    :return: a dict with chains (chain id -> sorted list of mention ids) of all linked mentions
+    """
+    chains_set = UnionFind(n_mentions)
+    for a, b in pairs:
+        chains_set.union(a, b)
+    return chains_set.chains()
+
+
 # class MentionPairClassifier(object):
 #     """
 #     A base classifier for mention-pair coreference resolution models
@@ -103,21 +164,159 @@ class DisjointSet(object):
 #         return False
 
 
+class CandidateGenerator(object):
+    """
+    Selects candidate antecedents for mention-pair resolution instead of taking all preceding mentions.
+    A candidate should be close enough (in mentions and in sentences), agree with a mention in gender and
+    number (if agreement blocking is on) and be among the closest candidates allowed for a type of a mention.
+    Numbers of pruned pairs are accumulated in self.stats
+    """
+    MENTION_TYPES = ('pronoun', 'proper', 'common')
+
+    def __init__(self, tagset, max_distance=None, max_sentences=None, max_candidates=None,
+                 agreement_features=('gender', 'number')):
+        """
+        :param max_distance: maximal distance in mentions between a mention and its antecedent
+        :param max_sentences: maximal distance in sentences between a mention and its antecedent
+        :param max_candidates: a dict mapping a type of a mention (pronoun, proper or common) to the maximal
+        number of its candidates (the closest ones are kept)
+        :param agreement_features: tagset features that should not contradict for a mention and its antecedent
+        (unknown values agree with anything), empty or None turns agreement blocking off
+        """
+        self.tagset = tagset
+        self.max_distance = max_distance
+        self.max_sentences = max_sentences
+        self.max_candidates = max_candidates or {}
+        self.agreement_features = agreement_features or ()
+
+        self.stats = collections.Counter()
+
+    def clear_stats(self):
+        self.stats = collections.Counter()
+
+    def mention_type(self, mention):
+        if self.tagset.pos_filters['pronoun'](mention):
+            return 'pronoun'
+        if self.tagset.pos_filters['properNoun'](mention):
+            return 'proper'
+        return 'common'
+
+    def sentence_ids(self, mentions, words):
+        """Returns an index of a sentence of each mention"""
+        if hasattr(words, 'tag_mask'):
+            sentence_ends = words.offsets[words.tag_mask(lambda tag: tag == 'SENT')].tolist()
+        else:
+            sentence_ends = [word.offset for word in words if word.tag == 'SENT']
+        return np.array([bisect.bisect_left(sentence_ends, mention.offset) for mention in mentions], dtype=int)
+
+    def agreement_codes(self, mentions):
+        """
+        Encodes agreement features of mentions
+        :return: an array (n_mentions x n_features) of codes of feature values, -1 means an unknown value
+        """
+        codes = np.full((len(mentions), len(self.agreement_features)), -1, dtype=int)
+        values_index = collections.defaultdict(dict)
+
+        for i, mention in enumerate(mentions):
+            for i_feature, name in enumerate(self.agreement_features):
+                value = self.tagset.extract_feature(name, mention)
+                if value is not None and value != '-':
+                    codes[i, i_feature] = values_index[name].setdefault(value, len(values_index[name]))
+
+        return codes
+
+    def candidates(self, mentions, words):
+        """
+        :param words: a text of mentions (used for finding sentence borders)
+        :return: a list with an array of candidate antecedents' indices for each mention, the closest ones first
+        """
+        n_mentions = len(mentions)
+        sentences = self.sentence_ids(mentions, words) if self.max_sentences is not None else None
+        codes = self.agreement_codes(mentions) if self.agreement_features else None
+
+        candidates = []
+        for i, mention in enumerate(mentions):
+            start = 0 if self.max_distance is None else max(0, i - self.max_distance)
+            antecedents = np.arange(i - 1, start - 1, -1)
+
+            self.stats['pairs'] += i
+            self.stats['pruned_distance'] += i - len(antecedents)
+
+            if sentences is not None:
+                antecedents = self._prune(antecedents, sentences[i] - sentences[antecedents] <= self.max_sentences,
+                                          'pruned_sentences')
+            if codes is not None:
+                agree = ((codes[antecedents] == codes[i]) | (codes[antecedents] == -1) | (codes[i] == -1)).all(axis=1)
+                antecedents = self._prune(antecedents, agree, 'pruned_agreement')
+
+            limit = self.max_candidates.get(self.mention_type(mention)) if self.max_candidates else None
+            if limit is not None and len(antecedents) > limit:
+                self.stats['pruned_type_limit'] += len(antecedents) - limit
+                antecedents = antecedents[:limit]
+
+            self.stats['candidates'] += len(antecedents)
+            candidates.append(antecedents)
+
+        return candidates
+
+    def pruned_pairs(self):
+        """Returns the total number of pairs that were not considered as candidates"""
+        return self.stats['pairs'] - self.stats['candidates']
+
+    def _prune(self, antecedents, mask, stat):
+        self.stats[stat] += len(antecedents) - int(mask.sum())
+        return antecedents[mask]
+
+
 class MentionPairClassifier(object):
     NEEDS_TRAINING = False
 
-    def __init__(self, scorer_path=None):
+    BATCH_SCORING = False
+    """If True, predict_pairs scores all candidate pairs of a text with one call of score_pairs"""
+
+    THRESHOLD = 0.5
+    """Pairs with scores (returned by score_pairs) above the threshold are coreferent"""
+
+    PICKLABLE = False
+    """
+    Subclasses that can be pickled together with everything they need for resolution may set it to True,
+    then texts can be resolved in a pool of processes (see score)
+    """
+
+    DECODING = 'closest'
+    """
+    How antecedents are chosen from candidates: 'closest' takes the closest coreferent candidate
+    that has not been used as an antecedent yet, 'best' takes the candidate with the highest score,
+    'aggressive' links a mention to all coreferent candidates. Strategies other than 'closest' need
+    scores of all pairs, so they always use batched scoring
+    """
+
+    def __init__(self, scorer_path=None, candidate_generator=None):
+        """
+        :param candidate_generator: a CandidateGenerator that prunes candidate antecedents;
+        if None, all preceding mentions are candidates
+        """
         self.scorer_path = scorer_path
+        self.candidate_generator = candidate_generator
 
     def predict_pairs(self, mentions, groups, words, parse, i_text):
+        if self.BATCH_SCORING or self.DECODING != 'closest':
+            return self.predict_pairs_batch(mentions, groups, words, parse, i_text)
+
         pairs = []
         discarded_pairs = []
         used_antecedents = set()
 
         rev_mentions = mentions[::-1]
+        candidates = self.candidate_generator.candidates(mentions, words) if self.candidate_generator else None
 
         for i_mention, mention in enumerate(mentions[1:]):
-            for antecedent in rev_mentions[len(rev_mentions) - i_mention - 1:]:
+            if candidates is None:
+                antecedents = rev_mentions[len(rev_mentions) - i_mention - 1:]
+            else:
+                antecedents = [mentions[j] for j in candidates[i_mention + 1]]
+
+            for antecedent in antecedents:
                 if antecedent in used_antecedents:
                     continue
 
@@ -129,6 +328,114 @@ class MentionPairClassifier(object):
                     discarded_pairs.append((antecedent, mention))
         return pairs, discarded_pairs
 
+    def predict_pairs_batch(self, mentions, groups, words, parse, i_text):
+        """
+        The same as predict_pairs, but all candidate pairs of a text are scored at once with score_pairs
+        and then decoded the same way: for each mention the closest antecedent that is coreferent
+        and has not been used yet is chosen
+        """
+        if len(mentions) < 2:
+            return [], []
+
+        candidates, candidate_pairs = self.candidate_pairs(mentions, words)
+        scores = self.score_pairs(candidate_pairs, groups, words, parse, i_text)
+        return self.decode_pairs(mentions, candidates, scores)
+
+    def candidate_pairs(self, mentions, words):
+        """
+        :return: a list with an array of candidate antecedents' indices for each mention (the closest ones first)
+        and a list of all candidate (antecedent, mention) pairs going mention by mention
+        """
+        if self.candidate_generator:
+            candidates = self.candidate_generator.candidates(mentions, words)
+        else:
+            candidates = [np.arange(i - 1, -1, -1) for i in range(len(mentions))]
+
+        return candidates, [(mentions[j], mentions[i]) for i, antecedents in enumerate(candidates) for j in antecedents]
+
+    def decode_pairs(self, mentions, candidates, scores):
+        """
+        Chooses antecedents from scored candidates according to DECODING
+        :param candidates: candidate antecedents of each mention (see candidate_pairs)
+        :param scores: scores of all candidate pairs in the order of candidate_pairs
+        :return: lists of coreferent and discarded pairs
+        """
+        pairs = []
+        discarded_pairs = []
+
+        n_mentions = len(mentions)
+        bounds = np.cumsum([0] + [len(antecedents) for antecedents in candidates])
+        scores = np.asarray(scores, dtype=float)
+        coreferent = scores > self.THRESHOLD
+
+        if self.DECODING in ('best', 'aggressive'):
+            for i in range(1, n_mentions):
+                antecedents = np.asarray(candidates[i], dtype=int)
+                mention_scores = scores[bounds[i]:bounds[i + 1]]
+                mention_coreferent = coreferent[bounds[i]:bounds[i + 1]]
+
+                discarded_pairs.extend((mentions[j], mentions[i]) for j in antecedents[~mention_coreferent])
+                if not mention_coreferent.any():
+                    continue
+                if self.DECODING == 'best':
+                    # the first maximum is the closest one
+                    pairs.append((mentions[antecedents[np.argmax(mention_scores)]], mentions[i]))
+                else:
+                    pairs.extend((mentions[j], mentions[i]) for j in antecedents[mention_coreferent])
+            return pairs, discarded_pairs
+
+        if self.DECODING != 'closest':
+            raise ValueError('Unknown decoding strategy: {}'.format(self.DECODING))
+
+        used_antecedents = np.zeros(n_mentions, dtype=bool)
+        for i in range(1, n_mentions):
+            antecedents = np.asarray(candidates[i], dtype=int)
+            available = ~used_antecedents[antecedents]
+            antecedents = antecedents[available]
+            found = np.flatnonzero(coreferent[bounds[i]:bounds[i + 1]][available])
+
+            n_discarded = found[0] if len(found) else len(antecedents)
+            discarded_pairs.extend((mentions[j], mentions[i]) for j in antecedents[:n_discarded])
+            if len(found):
+                antecedent = antecedents[found[0]]
+                pairs.append((mentions[antecedent], mentions[i]))
+                used_antecedents[antecedent] = True
+
+        return pairs, discarded_pairs
+
+    def score_pairs(self, pairs, groups, words, parse, i_text):
+        """
+        Scores a batch of candidate (antecedent, mention) pairs of a text. By default calls pair_coreferent
+        for each pair; ML-based classifiers should override it to build a feature matrix for all pairs
+        and call a model once (see pairs_probabilities)
+        :return: a list or an array with a score for each pair
+        """
+        return [1.0 if self.pair_coreferent(pair, groups, words, parse) else 0.0 for pair in pairs]
+
+    def score_pairs_batch(self, texts_pairs):
+        """
+        Scores candidate pairs of several texts. By default calls score_pairs for each text; ML-based
+        classifiers should override it to build one feature matrix for pairs of all texts and call a model once
+        :param texts_pairs: a list of tuples (pairs, groups, words, parse, i_text)
+        :return: a list with scores of pairs of each text
+        """
+        return [self.score_pairs(pairs, groups, words, parse, i_text)
+                for pairs, groups, words, parse, i_text in texts_pairs]
+
+    @staticmethod
+    def pairs_probabilities(model, x_data):
+        """
+        Returns probabilities of the positive (last) class for all rows of a feature matrix with a single call
+        of a model (predict_proba or, if there is no such method, a sigmoid of decision_function)
+        """
+        if not len(x_data):
+            return np.zeros(0)
+
+        if hasattr(model, 'predict_proba'):
+            return model.predict_proba(x_data)[:, -1]
+
+        return 1.0 / (1.0 + np.exp(-np.asarray(model.decision_function(x_data), dtype=float)))
+
     def convert_chains_to_groups(self, coref_chains, mentions, heads_only=False):
         groups = {}
 
@@ -155,42 +462,203 @@ class MentionPairClassifier(object):
 
     def resolve(self, mentions, groups, words, parse, i_text, return_heads_only=False):
         pairs, _ = self.predict_pairs(mentions, groups, words, parse, i_text)
+        return self._chains_and_groups(pairs, mentions, return_heads_only)
 
-        chains_set = DisjointSet()
-        chains = {}
+    def resolve_batch(self, texts, return_heads_only=False):
+        """
+        Resolves several texts at once: candidate pairs of all texts are scored with one call
+        of score_pairs_batch and then decoded text by text (the same way as predict_pairs_batch does)
+        :param texts: a list of tuples (mentions, groups, words, parse, i_text)
+        :return: a list of tuples (chains, groups) for each text
+        """
+        texts_candidates = []
+        texts_pairs = []
+        for mentions, groups, words, parse, i_text in texts:
+            candidates, candidate_pairs = self.candidate_pairs(mentions, words)
+            texts_candidates.append(candidates)
+            texts_pairs.append((candidate_pairs, groups, words, parse, i_text))
 
-        for pair in pairs:
-            chains_set.add(mentions.index(pair[0]), mentions.index(pair[1]))
-        for i_chain, chain in enumerate(list(chains_set.group.values())):
-            chains[i_chain + 1] = sorted(chain)
-        groups = self.convert_chains_to_groups(chains, mentions, return_heads_only)
+        texts_scores = self.score_pairs_batch(texts_pairs) if texts_pairs else []
+
+        results = []
+        for (mentions, _, _, _, _), candidates, scores in zip(texts, texts_candidates, texts_scores):
+            pairs, _ = self.decode_pairs(mentions, candidates, scores)
+            results.append(self._chains_and_groups(pairs, mentions, return_heads_only))
+        return results
+
+    def _chains_and_groups(self, pairs, mentions, heads_only):
+        positions = {}
+        for i_mention, mention in enumerate(mentions):
+            positions.setdefault(mention, i_mention)
+
+        chains = cluster_pairs(((positions[pair[0]], positions[pair[1]]) for pair in pairs), len(mentions))
+        groups = self.convert_chains_to_groups(chains, mentions, heads_only)
 
         return chains, groups
 
-    def score(self, corpus, mentions, groups, metrics=('muc',), heads_only=False):
-        if not self.scorer_path:
-            return {}, [], []
+    def resolve_texts(self, corpus, mentions, groups, heads_only=False, n_jobs=1):
+        """
+        Resolves coreference in all texts of a corpus
+        :param n_jobs: number of processes to use (-1 means all CPUs); only classifiers with PICKLABLE = True
+        are run in parallel, other ones resolve texts sequentially
+        :return: lists of chains and groups of all texts (in the order of texts)
+        """
+        tasks = ((mentions[i], groups[i], corpus.texts[i], corpus.parses[i] if corpus.parses else None, i, heads_only)
+                 for i in range(len(corpus.texts)))
+
+        if n_jobs == 1 or not self.PICKLABLE or len(corpus.texts) < 2:
+            results = [self.resolve(*task[:5], return_heads_only=task[5]) for task in tasks]
+        else:
+            n_jobs = multiprocessing.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+            # the classifier is sent to each process only once, tasks contain only data of one text
+            pool = multiprocessing.Pool(n_jobs, initializer=_init_resolve_worker, initargs=(self, ))
+            try:
+                results = list(pool.imap(_resolve_worker, tasks))
+            finally:
+                pool.close()
+                pool.join()
 
-        coref_chains = []
-        coref_groups = []
+        return [text_chains for text_chains, _ in results], [text_groups for _, text_groups in results]
 
-        for i, text in enumerate(corpus.texts):
-            text_chains, text_groups = self.resolve(mentions[i], groups[i], corpus.texts[i],
-                                                    corpus.parses[i] if corpus.parses else None, i,
-                                                    return_heads_only=heads_only)
-            coref_chains.append(text_chains)
-            coref_groups.append(text_groups)
+    def score(self, corpus, mentions, groups, metrics=('muc',), heads_only=False, session=None, n_jobs=1):
+        """
+        Resolves coreference in all texts of a corpus and scores the result
+        :param session: a scorer.ScoringSession for this corpus; if provided, GS prepared by the session is used
+        :param n_jobs: number of processes for resolving texts (see resolve_texts)
+        :return: a dict with scores (precision, recall, f1) for each metric, groups and chains of all texts
+        """
+        coref_chains, coref_groups = self.resolve_texts(corpus, mentions, groups, heads_only, n_jobs)
 
         scores_dict = {}
 
+        if session is not None:
+            all_scores = session.score(coref_groups, coref_chains, metrics=metrics, heads_only=heads_only)
+        elif self.scorer_path:
+            all_scores = {}
+            for metric in metrics:
+                all_scores[metric] = corpus.score_coreference(coref_groups, coref_chains,
+                                                              scorer_path=self.scorer_path,
+                                                              heads_only=heads_only,
+                                                              metric=metric)[metric]
+        else:
+            # the built-in scorer computes all metrics at once
+            all_scores = corpus.score_coreference(coref_groups, coref_chains,
+                                                  heads_only=heads_only,
+                                                  metric=metrics)
+
         for metric in metrics:
-            scores = corpus.score_coreference(coref_groups, coref_chains,
-                                              scorer_path=self.scorer_path,
-                                              heads_only=heads_only,
-                                              metric=metric)[metric]
+            scores = all_scores[metric]
             scores_dict[metric] = {score: (scores[score][1], scores[score][0], scores[score][2]) for score in scores}
 
         return scores_dict, coref_groups, coref_chains
 
     def pair_coreferent(self, pair, groups, words, parse):
         return False
+
+
+def soon_instances(mentions, text_gs):
+    """
+    Creates training instances of a text the way Soon et al. (2001) do: for each mention of a GS chain
+    its closest preceding mention of the same chain gives a positive pair, every mention between them
+    gives a negative pair with it. GS groups are matched with mentions by offsets of their heads
+    :param mentions: a list of mentions of a text
+    :param text_gs: GS of a text (a dict with chains and groups)
+    :return: three arrays: indices of antecedents, indices of anaphors and labels (True for positive pairs)
+    """
+    heads = sorted((mention.head_offset(), i_mention) for i_mention, mention in enumerate(mentions))
+    head_offsets = [head for head, _ in heads]
+
+    antecedents = []
+    anaphors = []
+    labels = []
+
+    for chain_id in sorted(text_gs['chains']):
+        chain_mentions = set()
+        for group_id in text_gs['chains'][chain_id]:
+            head = text_gs['groups'][group_id]['head_shift'][0]
+            i_head = bisect.bisect_left(head_offsets, head)
+            while i_head < len(heads) and head_offsets[i_head] == head:
+                chain_mentions.add(heads[i_head][1])
+                i_head += 1
+
+        chain_mentions = sorted(chain_mentions)
+        for antecedent, anaphor in zip(chain_mentions, chain_mentions[1:]):
+            antecedents.append(antecedent)
+            anaphors.append(anaphor)
+            labels.append(True)
+
+            antecedents.extend(range(antecedent + 1, anaphor))
+            anaphors.extend([anaphor] * (anaphor - antecedent - 1))
+            labels.extend([False] * (anaphor - antecedent - 1))
+
+    return np.array(antecedents, dtype=int), np.array(anaphors, dtype=int), np.array(labels, dtype=bool)
+
+
+def iter_training_instances(corpus, mentions, pair_features, batch_size=10000, n_jobs=1):
+    """
+    Generates Soon-style training instances (see soon_instances) for all texts of a corpus
+    :param mentions: a list of mentions of each text
+    :param pair_features: a function (pairs, groups, words, parse, i_text) returning a feature matrix
+    for a list of (antecedent, anaphor) pairs of a text; should be picklable if n_jobs is not 1
+    :param batch_size: number of instances in a batch (the last one may be smaller)
+    :param n_jobs: number of processes to use (-1 means all CPUs), texts keep their order
+    :return: yields tuples (x, y) of a feature matrix and an array of labels
+    """
+    tasks = ((pair_features, mentions[i], corpus.gs[i], corpus.groups[i] if corpus.groups else None,
+              corpus.texts[i], corpus.parses[i] if corpus.parses else None, i) for i in range(len(corpus.texts)))
+
+    pool = None
+    if n_jobs == 1:
+        results = (_training_instances_worker(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(multiprocessing.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs)
+        results = pool.imap(_training_instances_worker, tasks)
+
+    try:
+        batch_x = []
+        batch_y = []
+        n_batch = 0
+        for x, y in results:
+            start = 0
+            while start < len(y):
+                end = start + batch_size - n_batch
+                batch_x.append(x[start:end])
+                batch_y.append(y[start:end])
+                n_batch += len(y[start:end])
+                start = end
+                if n_batch == batch_size:
+                    yield np.concatenate(batch_x), np.concatenate(batch_y)
+                    batch_x = []
+                    batch_y = []
+                    n_batch = 0
+        if n_batch:
+            yield np.concatenate(batch_x), np.concatenate(batch_y)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def _training_instances_worker(task):
+    pair_features, mentions, text_gs, groups, words, parse, i_text = task
+    antecedents, anaphors, labels = soon_instances(mentions, text_gs)
+    if not len(labels):
+        return np.zeros((0, 0)), labels
+
+    x = np.asarray(pair_features([(mentions[antecedent], mentions[anaphor])
+                                  for antecedent, anaphor in zip(antecedents, anaphors)],
+                                 groups, words, parse, i_text), dtype=float)
+    return x, labels
+
+
+_worker_classifier = None
+
+
+def _init_resolve_worker(classifier):
+    global _worker_classifier
+    _worker_classifier = classifier
+
+
+def _resolve_worker(task):
+    mentions, groups, words, parse, i_text, heads_only = task
+    return _worker_classifier.resolve(mentions, groups, words, parse, i_text, return_heads_only=heads_only)
@@ -0,0 +1,137 @@
+"""
+Saving and loading of trained models (e.g. scikit-learn estimators) so that many processes can share them.
+A model is saved to a directory: NumPy arrays of a model go to separate .npy files, everything else
+is pickled with references to these files, and header.json describes the model (format version,
+class, tagset, feature names, etc.). When a model is loaded, arrays are memory-mapped, so all processes
+that load the same model share one physical copy of its arrays
+"""
+
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import pickle
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+HEADER_FILENAME = 'header.json'
+MODEL_FILENAME = 'model.pickle'
+
+
+def save_model(model, path, metadata=None):
+    """
+    Saves a model to a directory
+    :param metadata: a JSON-serializable dict stored in the header (e.g. tagset and feature names)
+    :return: the header
+    """
+    if os.path.exists(path) and not os.path.isdir(path):
+        raise ValueError('Provided path ({}) is not a folder'.format(path))
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    arrays = []
+    with open(os.path.join(path, MODEL_FILENAME), 'wb') as out_file:
+        _ArraysPickler(out_file, path, arrays).dump(model)
+
+    header = {'format_version': FORMAT_VERSION,
+              'model_class': '{}.{}'.format(model.__class__.__module__, model.__class__.__name__),
+              'arrays': arrays,
+              'metadata': metadata or {}}
+    with io.open(os.path.join(path, HEADER_FILENAME), 'w', encoding='utf-8') as out_file:
+        out_file.write(json.dumps(header, ensure_ascii=False, indent=2))
+
+    return header
+
+
+def read_header(path):
+    """Reads a header of a saved model without loading the model"""
+    with io.open(os.path.join(path, HEADER_FILENAME), encoding='utf-8') as inp_file:
+        header = json.load(inp_file)
+
+    if header.get('format_version') != FORMAT_VERSION:
+        raise ValueError('Unsupported model format version: {} (expected {})'.format(header.get('format_version'),
+                                                                                    FORMAT_VERSION))
+    return header
+
+
+def load_model(path, mmap=True, lazy=False):
+    """
+    Loads a model saved with save_model
+    :param mmap: if True, arrays are memory-mapped (read-only) instead of being read into memory
+    :param lazy: if True, returns a LazyModel that loads the model on the first use
+    """
+    read_header(path)
+    if lazy:
+        return LazyModel(path, mmap)
+
+    with open(os.path.join(path, MODEL_FILENAME), 'rb') as inp_file:
+        return _ArraysUnpickler(inp_file, path, mmap).load()
+
+
+class LazyModel(object):
+    """
+    A proxy of a saved model that loads it on the first access to any of its attributes (e.g. predict).
+    Pickling a proxy pickles only a path, so it is cheap to send to worker processes
+    """
+    def __init__(self, path, mmap=True):
+        self.path_ = path
+        self.mmap_ = mmap
+        self.model_ = None
+        self.header = read_header(path)
+
+    def load(self):
+        if self.model_ is None:
+            self.model_ = load_model(self.path_, self.mmap_)
+        return self.model_
+
+    def __getattr__(self, name):
+        # attributes of the proxy itself are never delegated (they may be missing while unpickling)
+        if name in ('path_', 'mmap_', 'model_', 'header'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __bool__(self):
+        return True
+
+    __nonzero__ = __bool__
+
+    def __reduce__(self):
+        return LazyModel, (self.path_, self.mmap_)
+
+
+class _ArraysPickler(pickle.Pickler):
+    def __init__(self, out_file, path, arrays):
+        pickle.Pickler.__init__(self, out_file, protocol=2)
+        self.path = path
+        self.arrays = arrays
+        # arrays are kept alive in the memo: an array created while pickling (e.g. by __reduce__) and freed
+        # afterwards may give its id to another array
+        self.saved_arrays = {}
+
+    def persistent_id(self, obj):
+        if type(obj) is not np.ndarray or obj.dtype.hasobject:
+            return None
+
+        if id(obj) not in self.saved_arrays:
+            filename = 'array_{:06d}.npy'.format(len(self.arrays))
+            np.save(os.path.join(self.path, filename), obj)
+            self.arrays.append(filename)
+            self.saved_arrays[id(obj)] = (obj, filename)
+        return self.saved_arrays[id(obj)][1]
+
+
+class _ArraysUnpickler(pickle.Unpickler):
+    def __init__(self, inp_file, path, mmap):
+        pickle.Unpickler.__init__(self, inp_file)
+        self.path = path
+        self.mmap = mmap
+        self.loaded_arrays = {}
+
+    def persistent_load(self, filename):
+        if filename not in self.loaded_arrays:
+            self.loaded_arrays[filename] = np.load(os.path.join(self.path, filename),
+                                                   mmap_mode='r' if self.mmap else None)
+        return self.loaded_arrays[filename]
@@ -0,0 +1,508 @@
+"""
+Coreference scorer that computes the same metrics as the CoNLL reference scorer (scorer.pl)
+directly from chains in memory: MUC, B-cubed, CEAF-m, CEAF-e, BLANC and LEA.
+Documents are represented as lists of clusters, each cluster is a list of mentions (any hashable objects).
+Scores of all documents are micro-averaged the same way scorer.pl does it
+"""
+
+from __future__ import division
+from __future__ import unicode_literals
+
+import collections
+import itertools
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+METRICS = ('muc', 'bcub', 'ceafm', 'ceafe', 'blanc', 'lea')
+
+
+def mention_span(tokens_shifts):
+    """
+    Returns a key of a mention: offsets of its first and last tokens. The CoNLL format represents
+    a mention only by its borders, so groups with the same key are the same mention for scorer.pl
+    """
+    return tokens_shifts[0], tokens_shifts[-1]
+
+
+def get_clusters(groups, chains):
+    """
+    Converts a document in a format used by Corpus.export_conll to a list of clusters.
+    A mention is represented by its span (see mention_span), only the first of the groups
+    with the same span is used
+    :param groups: a dict mapping group ids to dicts with tokens_shifts
+    :param chains: a dict mapping chain ids to lists of group ids
+    :return: a list of clusters
+    """
+    chains_index = {group_id: chain_id for chain_id in chains for group_id in chains[chain_id]}
+    clusters = collections.OrderedDict()
+    used_mentions = set()
+
+    for group_id in sorted(groups):
+        if group_id not in chains_index:
+            continue
+        mention = mention_span(groups[group_id]['tokens_shifts'])
+        if mention in used_mentions:
+            continue
+        used_mentions.add(mention)
+        clusters.setdefault(chains_index[group_id], []).append(mention)
+
+    return list(clusters.values())
+
+
+def score(key_docs, response_docs, metrics='all'):
+    """
+    Scores response clusters against key clusters
+    :param key_docs: a list of documents, each one is a list of key clusters
+    :param response_docs: a list of documents with response clusters (in the same order)
+    :param metrics: 'all', a name of a metric or a list of names (see METRICS)
+    :return: a dict mapping each metric to a dict of scores: {name: (recall, precision, f1)} in percents,
+    the same as Corpus.score_coreference returns for scorer.pl
+    """
+    if metrics == 'all':
+        metrics = METRICS
+    elif not isinstance(metrics, (list, tuple, set)):
+        metrics = (metrics, )
+
+    for metric in metrics:
+        if metric not in METRICS:
+            raise ValueError('Unknown metric: {}'.format(metric))
+
+    counts = collections.defaultdict(lambda: [0.0, 0.0, 0.0, 0.0])
+    for key, response in zip(key_docs, response_docs):
+        doc = _Document(key, response)
+        for name, doc_counts in itertools.chain([('mentions', doc.mentions())],
+                                                ((metric, _metric_functions[metric](doc)) for metric in metrics
+                                                 if metric != 'blanc'),
+                                                doc.blanc() if 'blanc' in metrics else []):
+            for i, value in enumerate(doc_counts):
+                counts[name][i] += value
+
+    mentions_scores = _scores(*counts['mentions'])
+    results = {}
+    for metric in metrics:
+        results[metric] = {'Identification of Mentions': mentions_scores}
+        if metric == 'blanc':
+            results[metric].update(_blanc_scores(counts))
+        else:
+            results[metric]['Coreference'] = _scores(*counts[metric])
+
+    return results
+
+
+def run_reference_scorer(key_filename, response_filename, metric='all', scorer_path='scorer.pl', perl_path='perl'):
+    """
+    Runs the CoNLL reference scorer (scorer.pl) on two files in the CoNLL format and parses its output
+    :return: a dict mapping each metric to a dict of scores: {name: (recall, precision, f1)} in percents
+    (floats, the same as score() returns)
+    """
+    rx_metric = re.compile('METRIC ([a-z]+):')
+    rx_score = re.compile(r'([A-Za-z\- ]+): Recall:.* ([0-9\.]+)%\tPrecision:.* ([0-9\.]+)%\tF1:.* ([0-9\.]+)%')
+
+    scorer_params = [perl_path,
+                     scorer_path,
+                     metric,
+                     key_filename,
+                     response_filename,
+                     'none']
+
+    output = subprocess.check_output(scorer_params).decode('utf-8').split('\n')
+
+    scores = collections.defaultdict(dict)
+    for line in output:
+        line = line.strip('\r\n')
+        m = rx_metric.match(line)
+        if m:
+            metric = m.group(1)
+        m = rx_score.match(line)
+        if m:
+            scores[metric][m.group(1)] = (float(m.group(2)), float(m.group(3)), float(m.group(4)))
+
+    return dict(scores)
+
+
+class ScoringSession(object):
+    """
+    Scores many system outputs for the same corpus (e.g. in hyperparameter sweeps).
+    GS is prepared only once for each variant (full groups and heads only), system outputs
+    are scored concurrently: in a pool of processes with the built-in scorer and in threads running
+    scorer.pl processes otherwise. With scorer.pl, every system output is exported to its own temporary directory.
+    Use it as a context manager or call close() to remove temporary files
+    """
+    def __init__(self, corpus, scorer_path=None, perl_path='perl', n_jobs=1):
+        """
+        :param corpus: a corpus with loaded texts and GS
+        :param scorer_path: a path to scorer.pl; if None, the built-in scorer is used
+        :param n_jobs: number of systems scored at the same time (-1 means all CPUs)
+        """
+        self.corpus = corpus
+        self.scorer_path = scorer_path
+        self.perl_path = perl_path
+        self.n_jobs = multiprocessing.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+
+        self.tmp_dir = None
+        self.keys_ = {}
+        """Maps heads_only to GS clusters (built-in scorer) or to a GS file (scorer.pl)"""
+
+        if self.scorer_path is not None:
+            self.corpus.create_indices()
+            self.tmp_dir = tempfile.mkdtemp(prefix='rucor_scoring_')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            self.tmp_dir = None
+
+    def key(self, heads_only=False):
+        """Returns GS prepared for scoring, it is created on the first call"""
+        if heads_only not in self.keys_:
+            gs_groups = self.corpus._gs_heads() if heads_only else [text_gs['groups'] for text_gs in self.corpus.gs]
+            gs_chains = [text_gs['chains'] for text_gs in self.corpus.gs]
+
+            if self.scorer_path is None:
+                self.keys_[heads_only] = [get_clusters(gs_groups[i], gs_chains[i]) for i in range(len(gs_groups))]
+            else:
+                key_filename = os.path.join(self.tmp_dir, 'gold_heads.txt' if heads_only else 'gold.txt')
+                self.corpus.export_conll(key_filename, groups=gs_groups, chains=gs_chains, update_indices=False)
+                self.keys_[heads_only] = key_filename
+
+        return self.keys_[heads_only]
+
+    def score(self, groups, chains, metrics='all', heads_only=False):
+        """
+        Scores one system output
+        :param groups: a list of dicts with groups (with tokens_shifts) for every text
+        :param chains: a list of dicts with chains (lists of group ids) for every text
+        :return: the same dict as score() returns
+        """
+        key = self.key(heads_only)
+
+        if self.scorer_path is None:
+            return score(key, [get_clusters(groups[i], chains[i]) for i in range(len(groups))], metrics)
+
+        system_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        try:
+            response_filename = os.path.join(system_dir, 'test.txt')
+            self.corpus.export_conll(response_filename, groups=groups, chains=chains, update_indices=False)
+            if metrics == 'all' or not isinstance(metrics, (list, tuple, set)):
+                return run_reference_scorer(key, response_filename, metrics, self.scorer_path, self.perl_path)
+            if len(metrics) == 1:
+                return run_reference_scorer(key, response_filename, list(metrics)[0],
+                                            self.scorer_path, self.perl_path)
+            scores = run_reference_scorer(key, response_filename, 'all', self.scorer_path, self.perl_path)
+            return {metric: scores[metric] for metric in metrics}
+        finally:
+            shutil.rmtree(system_dir, ignore_errors=True)
+
+    def score_many(self, systems, metrics='all', heads_only=False):
+        """
+        Scores a number of system outputs
+        :param systems: a dict mapping names of systems to tuples (groups, chains) or a list of such tuples
+        (then systems are named by their indices)
+        :return: an OrderedDict mapping names of systems to their scores (see score()) in the order of systems
+        """
+        names = list(systems) if isinstance(systems, dict) else list(range(len(systems)))
+        outputs = [systems[name] for name in names]
+
+        self.key(heads_only)  # GS is prepared before starting threads
+
+        def score_system(output):
+            return self.score(output[0], output[1], metrics, heads_only)
+
+        if self.n_jobs == 1 or len(outputs) < 2:
+            results = [score_system(output) for output in outputs]
+        elif self.scorer_path is None:
+            # the built-in scorer is pure Python, so systems are scored in processes; GS is sent to each one once
+            pool = multiprocessing.Pool(min(self.n_jobs, len(outputs)), initializer=_init_score_worker,
+                                        initargs=(self.key(heads_only), metrics))
+            try:
+                results = pool.map(_score_worker, outputs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            # threads are enough to run several scorer.pl processes at the same time
+            pool = ThreadPool(min(self.n_jobs, len(outputs)))
+            try:
+                results = pool.map(score_system, outputs)
+            finally:
+                pool.close()
+                pool.join()
+
+        return collections.OrderedDict(zip(names, results))
+
+
+_worker_key = None
+_worker_metrics = None
+
+
+def _init_score_worker(key, metrics):
+    global _worker_key, _worker_metrics
+    _worker_key = key
+    _worker_metrics = metrics
+
+
+def _score_worker(output):
+    groups, chains = output
+    return score(_worker_key, [get_clusters(groups[i], chains[i]) for i in range(len(groups))], _worker_metrics)
+
+
+def score_table(results, metrics=('muc', 'bcub', 'ceafm'), score_name='Coreference'):
+    """
+    Converts results of ScoringSession.score_many to a table
+    :return: a list of rows: a name of a system followed by (recall, precision, f1) of each metric
+    """
+    return [[name] + [float(value) for metric in metrics
+                      for value in scores[metric]['BLANC' if metric == 'blanc' else score_name]]
+            for name, scores in results.items()]
+
+
+class _Document(object):
+    def __init__(self, key, response):
+        self.key = [list(cluster) for cluster in key if cluster]
+        self.response = [list(cluster) for cluster in response if cluster]
+
+        self.key_index = {mention: i for i, cluster in enumerate(self.key) for mention in cluster}
+        self.response_index = {mention: i for i, cluster in enumerate(self.response) for mention in cluster}
+
+        # sizes of non-empty intersections of key and response clusters
+        self.overlaps = collections.Counter((self.key_index[mention], self.response_index[mention])
+                                            for mention in self.key_index if mention in self.response_index)
+
+    def mentions(self):
+        common = sum(self.overlaps.values())
+        return common, len(self.key_index), common, len(self.response_index)
+
+    def muc(self):
+        recall_num = recall_den = precision_num = precision_den = 0
+
+        key_partitions = collections.Counter(k for k, r in self.overlaps)
+        response_partitions = collections.Counter(r for k, r in self.overlaps)
+        key_common = collections.Counter()
+        response_common = collections.Counter()
+        for (k, r), n in self.overlaps.items():
+            key_common[k] += n
+            response_common[r] += n
+
+        for k, cluster in enumerate(self.key):
+            # mentions missing in the response are partitions on their own
+            recall_num += len(cluster) - key_partitions[k] - (len(cluster) - key_common[k])
+            recall_den += len(cluster) - 1
+        for r, cluster in enumerate(self.response):
+            precision_num += len(cluster) - response_partitions[r] - (len(cluster) - response_common[r])
+            precision_den += len(cluster) - 1
+
+        return recall_num, recall_den, precision_num, precision_den
+
+    def bcub(self):
+        recall_num = sum(n * n / len(self.key[k]) for (k, r), n in self.overlaps.items())
+        precision_num = sum(n * n / len(self.response[r]) for (k, r), n in self.overlaps.items())
+        return recall_num, len(self.key_index), precision_num, len(self.response_index)
+
+    def ceafm(self):
+        similarity = _max_similarity(self.overlaps, lambda k, r, n: n)
+        return similarity, len(self.key_index), similarity, len(self.response_index)
+
+    def ceafe(self):
+        similarity = _max_similarity(self.overlaps,
+                                     lambda k, r, n: 2.0 * n / (len(self.key[k]) + len(self.response[r])))
+        return similarity, len(self.key), similarity, len(self.response)
+
+    def lea(self):
+        common_links = collections.Counter()
+        response_common_links = collections.Counter()
+        for (k, r), n in self.overlaps.items():
+            if len(self.key[k]) == 1 and len(self.response[r]) == 1:
+                # a singleton is resolved if it is a singleton in both key and response
+                common_links[k] += 1
+                response_common_links[r] += 1
+            else:
+                common_links[k] += _links(n)
+                response_common_links[r] += _links(n)
+
+        recall_num = sum(len(cluster) * common_links[k] / max(_links(len(cluster)), 1)
+                         for k, cluster in enumerate(self.key))
+        precision_num = sum(len(cluster) * response_common_links[r] / max(_links(len(cluster)), 1)
+                            for r, cluster in enumerate(self.response))
+        return recall_num, len(self.key_index), precision_num, len(self.response_index)
+
+    def blanc(self):
+        key_links = sum(_links(len(cluster)) for cluster in self.key)
+        response_links = sum(_links(len(cluster)) for cluster in self.response)
+        common_links = sum(_links(n) for n in self.overlaps.values())
+
+        key_non_links = _links(len(self.key_index)) - key_links
+        response_non_links = _links(len(self.response_index)) - response_links
+
+        # non-coreference links present in both key and response are links between common mentions
+        # that are in different clusters both in key and response
+        key_common = collections.Counter()
+        response_common = collections.Counter()
+        for (k, r), n in self.overlaps.items():
+            key_common[k] += n
+            response_common[r] += n
+        common_non_links = _links(sum(self.overlaps.values())) \
+            - sum(_links(n) for n in key_common.values()) \
+            - sum(_links(n) for n in response_common.values()) \
+            + common_links
+
+        return [('blanc_coref', (common_links, key_links, common_links, response_links)),
+                ('blanc_non_coref', (common_non_links, key_non_links, common_non_links, response_non_links))]
+
+
+_metric_functions = {
+    'muc': _Document.muc,
+    'bcub': _Document.bcub,
+    'ceafm': _Document.ceafm,
+    'ceafe': _Document.ceafe,
+    'lea': _Document.lea
+}
+
+
+def _links(n):
+    return n * (n - 1) // 2
+
+
+def _f1(recall, precision):
+    return 2 * recall * precision / (recall + precision) if recall + precision else 0.0
+
+
+def _scores(recall_num, recall_den, precision_num, precision_den):
+    recall = recall_num / recall_den if recall_den else 0.0
+    precision = precision_num / precision_den if precision_den else 0.0
+    return 100 * recall, 100 * precision, 100 * _f1(recall, precision)
+
+
+def _blanc_scores(counts):
+    """Computes BLANC with the edge cases of Luo et al. (2014): if the key has no coreference
+    (or no non-coreference) links, only the other kind of links is scored"""
+    coref = counts['blanc_coref']
+    non_coref = counts['blanc_non_coref']
+
+    if not any(coref) and not any(non_coref):
+        # only single-mention documents: the response is either perfect or completely wrong
+        mentions = counts['mentions']
+        perfect = mentions[0] == mentions[1] == mentions[3]
+        coref_scores = non_coref_scores = blanc = (100.0, 100.0, 100.0) if perfect else (0.0, 0.0, 0.0)
+    else:
+        coref_scores = _links_scores(*coref)
+        non_coref_scores = _links_scores(*non_coref)
+        if not coref[1]:
+            blanc = non_coref_scores
+        elif not non_coref[1]:
+            blanc = coref_scores
+        else:
+            blanc = tuple((coref_score + non_coref_score) / 2
+                          for coref_score, non_coref_score in zip(coref_scores, non_coref_scores))
+
+    return {'Coreference links': coref_scores,
+            'Non-coreference links': non_coref_scores,
+            'BLANC': blanc}
+
+
+def _links_scores(common, key_links, _, response_links):
+    if not key_links and not response_links:
+        return 100.0, 100.0, 100.0
+    if not key_links or not response_links:
+        return 0.0, 0.0, 0.0
+    return _scores(common, key_links, common, response_links)
+
+
+def _max_similarity(overlaps, similarity):
+    """
+    Finds the best one-to-one alignment of key and response clusters (as in CEAF).
+    Only overlapping clusters have non-zero similarity, so the alignment is found separately
+    for each connected component of the overlap graph
+    :param overlaps: a dict mapping pairs (key cluster, response cluster) to the size of their intersection
+    :return: the total similarity of the alignment
+    """
+    neighbours = collections.defaultdict(set)
+    for k, r in overlaps:
+        neighbours[('k', k)].add(('r', r))
+        neighbours[('r', r)].add(('k', k))
+
+    total = 0.0
+    visited = set()
+    for node in neighbours:
+        if node in visited:
+            continue
+
+        component = []
+        stack = [node]
+        visited.add(node)
+        while stack:
+            cur = stack.pop()
+            component.append(cur)
+            for neighbour in neighbours[cur]:
+                if neighbour not in visited:
+                    visited.add(neighbour)
+                    stack.append(neighbour)
+
+        keys = [k for side, k in component if side == 'k']
+        responses = [r for side, r in component if side == 'r']
+        weights = [[similarity(k, r, overlaps[k, r]) if (k, r) in overlaps else 0.0 for r in responses]
+                   for k in keys]
+        total += _max_weight_matching(weights)
+
+    return total
+
+
+def _max_weight_matching(weights):
+    """Hungarian algorithm: returns the maximal total weight of a matching in a bipartite graph
+    given as a matrix of weights"""
+    if len(weights) > len(weights[0]):
+        weights = [list(row) for row in zip(*weights)]
+    n, m = len(weights), len(weights[0])
+    if n == 1:
+        return max(weights[0])
+
+    infinity = float('inf')
+    u = [0.0] * (n + 1)
+    v = [0.0] * (m + 1)
+    matching = [0] * (m + 1)
+    way = [0] * (m + 1)
+
+    for i in range(1, n + 1):
+        matching[0] = i
+        j0 = 0
+        min_values = [infinity] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[j0] = True
+            i0 = matching[j0]
+            delta = infinity
+            j1 = 0
+            for j in range(1, m + 1):
+                if not used[j]:
+                    cur = -weights[i0 - 1][j - 1] - u[i0] - v[j]
+                    if cur < min_values[j]:
+                        min_values[j] = cur
+                        way[j] = j0
+                    if min_values[j] < delta:
+                        delta = min_values[j]
+                        j1 = j
+            for j in range(m + 1):
+                if used[j]:
+                    u[matching[j]] += delta
+                    v[j] -= delta
+                else:
+                    min_values[j] -= delta
+            j0 = j1
+            if matching[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            matching[j0] = matching[j1]
+            j0 = j1
+
+    return sum(weights[matching[j] - 1][j - 1] for j in range(1, m + 1) if matching[j])
@@ -0,0 +1,411 @@
+"""
+A long-running coreference resolution service. The tagset and a classifier are loaded once, documents
+are accepted as JSON (one per line on stdin or POST requests to a local HTTP server) and grouped into small
+batches; candidate pairs of all documents of a batch are scored with one call of the classifier
+(MentionPairClassifier.resolve_batch). Responses contain chains and groups in the same format
+as MentionPairClassifier.resolve.
+
+A document is a JSON object: {"id": ..., "tokens": [{"token": ..., "lemma": ..., "gram": ...,
+"shift": ..., "length": ...}, ...]} (tokens have the same fields as a RuCor tokens file, head and rel are optional).
+A request {"command": "stats"} (or GET /stats) returns latency and throughput counters.
+
+Usage: python -m anaphoralib.service --classifier module:ClassName [--http PORT]
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import collections
+import importlib
+import io
+import itertools
+import json
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from . import persistence
+from . import utils
+from .corpora import rueval
+
+
+class ResolutionService(object):
+    """
+    Resolves documents in a background thread. Documents submitted at about the same time are
+    processed as one batch (up to batch_size documents, waiting at most max_wait seconds for a batch to fill)
+    """
+    def __init__(self, tagset, classifier, batch_size=16, max_wait=0.005, use_parses=True):
+        """
+        :param classifier: a MentionPairClassifier (or anything with the same resolve method;
+        documents of a batch are resolved together only if it also has resolve_batch)
+        """
+        self.tagset = tagset
+        self.classifier = classifier
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.use_parses = use_parses
+
+        self.queue = queue.Queue()
+        self.text_ids = itertools.count()
+        self.counters = collections.Counter()
+        self.max_latency = 0.0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, document):
+        """
+        Adds a document to the queue
+        :return: a PendingResult, call its get() to wait for the response
+        """
+        pending = PendingResult(document)
+        self.queue.put(pending)
+        return pending
+
+    def resolve(self, document, timeout=None):
+        """
+        Resolves a document and waits for the response
+        :param timeout: seconds to wait, if the response is not ready by then, an error response is returned
+        """
+        return self.submit(document).get(timeout)
+
+    def resolve_document(self, document):
+        """
+        Resolves a document in the calling thread
+        :return: a response: a dict with id, chains and groups
+        """
+        response = self.resolve_documents([document])[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def resolve_documents(self, documents):
+        """
+        Resolves several documents in the calling thread. Groups and mentions are found document by document,
+        then the classifier resolves all documents with one call of resolve_batch (if it has such a method)
+        Each document gets its own text index (i_text of the classifier), unique for the lifetime of the service,
+        so classifiers that cache data by text indices never mix documents
+        :return: a list of responses (an exception instead of a response for a document that failed)
+        """
+        responses = [None] * len(documents)
+        texts = []
+        text_documents = []
+
+        for i, document in enumerate(documents):
+            try:
+                if not isinstance(document, dict):
+                    raise ValueError('A document should be a JSON object')
+                if not isinstance(document.get('tokens'), list):
+                    raise ValueError('tokens of a document should be a list')
+                text, parse = rueval.text_from_tokens(document['tokens'])
+                parse = parse if self.use_parses else None
+
+                groups = utils.find_groups(text, self.tagset, parse)
+                mentions = utils.find_mentions(groups, self.tagset)
+            except Exception as e:
+                responses[i] = e
+                continue
+            texts.append((mentions, groups, text, parse, next(self.text_ids)))
+            text_documents.append(i)
+
+        results = None
+        if texts and hasattr(self.classifier, 'resolve_batch'):
+            try:
+                results = self.classifier.resolve_batch(texts)
+            except Exception:
+                # documents are resolved one by one to find out which of them failed
+                results = None
+
+        for i_text, (i, text) in enumerate(zip(text_documents, texts)):
+            try:
+                chains, coref_groups = results[i_text] if results is not None else self.classifier.resolve(*text)
+            except Exception as e:
+                responses[i] = e
+                continue
+
+            responses[i] = {'id': documents[i].get('id'),
+                            'chains': {str(chain_id): [int(group_id) for group_id in chain]
+                                       for chain_id, chain in chains.items()},
+                            'groups': {str(group_id): {'parent': int(group['parent']),
+                                                       'tokens_shifts': [int(shift)
+                                                                         for shift in group['tokens_shifts']]}
+                                       for group_id, group in coref_groups.items()}}
+
+        return responses
+
+    def stats(self):
+        """Returns counters: numbers of documents, batches and errors, latency (in seconds) and throughput"""
+        with self.lock:
+            counters = dict(self.counters)
+            max_latency = self.max_latency
+        uptime = time.time() - self.started
+        documents = counters.get('documents', 0)
+
+        return {'documents': documents,
+                'batches': counters.get('batches', 0),
+                'errors': counters.get('errors', 0),
+                'tokens': counters.get('tokens', 0),
+                'queued': self.queue.qsize(),
+                'mean_batch_size': documents / counters['batches'] if counters.get('batches') else 0.0,
+                'mean_latency': counters.get('latency', 0.0) / documents if documents else 0.0,
+                'max_latency': max_latency,
+                'uptime': uptime,
+                'documents_per_second': documents / uptime if uptime else 0.0}
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        # nothing may stop this loop: if it stopped, no document would ever be resolved again
+        while True:
+            batch = self._next_batch()
+            try:
+                self._process_batch(batch)
+            except Exception as e:
+                for pending in batch:
+                    if not pending.ready.is_set():
+                        pending.set(_error_response(pending.document, e), error=True)
+
+    def _process_batch(self, batch):
+        try:
+            responses = self.resolve_documents([pending.document for pending in batch])
+        except Exception as e:
+            responses = [e] * len(batch)
+
+        for pending, response in zip(batch, responses):
+            if isinstance(response, Exception):
+                pending.set(_error_response(pending.document, response), error=True)
+            else:
+                pending.set(response)
+
+        with self.lock:
+            self.counters['batches'] += 1
+            for pending in batch:
+                latency = pending.finished - pending.submitted
+                self.counters['documents'] += 1
+                self.counters['errors'] += pending.error
+                self.counters['tokens'] += _n_tokens(pending.document)
+                self.counters['latency'] += latency
+                self.max_latency = max(self.max_latency, latency)
+
+
+class PendingResult(object):
+    """A response that is not ready yet"""
+    def __init__(self, document):
+        self.document = document
+        self.submitted = time.time()
+        self.finished = None
+        self.response = None
+        self.error = False
+        self.ready = threading.Event()
+
+    def set(self, response, error=False):
+        self.response = response
+        self.error = error
+        self.finished = time.time()
+        self.ready.set()
+
+    def get(self, timeout=None):
+        """Waits for the response; if it is not ready in timeout seconds, returns an error response"""
+        if not self.ready.wait(timeout):
+            return _error_response(self.document, RuntimeError('No response in {} seconds'.format(timeout)))
+        return self.response
+
+
+def serve_stdio(service, inp_file=None, out_file=None, timeout=60.0):
+    """
+    Reads documents from stdin (a JSON object per line) and writes responses to stdout
+    in the same order. Lines are read ahead, so documents are batched while previous ones are resolved
+    :param timeout: seconds to wait for a response to a document, then an error response is written
+    """
+    inp_file = inp_file or io.open(sys.stdin.fileno(), encoding='utf-8', closefd=False)
+    out_file = out_file or io.open(sys.stdout.fileno(), 'w', encoding='utf-8', closefd=False)
+
+    pending_results = queue.Queue()
+
+    def write_responses():
+        while True:
+            pending = pending_results.get()
+            if pending is None:
+                break
+            out_file.write(json.dumps(pending.get(timeout), ensure_ascii=False) + '\n')
+            out_file.flush()
+
+    writer = threading.Thread(target=write_responses)
+    writer.start()
+
+    try:
+        for line in inp_file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                pending_results.put(_ready_result({'error': 'Invalid JSON: {}'.format(e)}))
+                continue
+
+            if not isinstance(request, dict):
+                pending_results.put(_ready_result({'error': 'A request should be a JSON object'}))
+            elif request.get('command') == 'stats':
+                pending_results.put(_ready_result(service.stats()))
+            else:
+                pending_results.put(service.submit(request))
+    finally:
+        pending_results.put(None)
+        writer.join()
+
+
+def serve_http(service, host='127.0.0.1', port=8000, timeout=60.0):
+    """
+    Serves requests on a local HTTP socket: POST /resolve with a document, GET /stats for counters.
+    Requests are handled in threads, so concurrent documents are batched
+    :param timeout: seconds to wait for a response to a document, then an error response is sent
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') == '/stats':
+                self._send(200, service.stats())
+            else:
+                self._send(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/resolve':
+                self._send(404, {'error': 'Not found'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                document = json.loads(self.rfile.read(length).decode('utf-8'))
+            except ValueError as e:
+                self._send(400, {'error': 'Invalid JSON: {}'.format(e)})
+                return
+            if not isinstance(document, dict):
+                self._send(400, {'error': 'A document should be a JSON object'})
+                return
+
+            response = service.resolve(document, timeout)
+            self._send(500 if 'error' in response else 200, response)
+
+        def _send(self, code, response):
+            body = json.dumps(response, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = _ThreadingHTTPServer((host, port), Handler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _error_response(document, error):
+    return {'id': document.get('id') if isinstance(document, dict) else None,
+            'error': '{}: {}'.format(error.__class__.__name__, error)}
+
+
+def _n_tokens(document):
+    tokens = document.get('tokens') if isinstance(document, dict) else None
+    return len(tokens) if isinstance(tokens, list) else 0
+
+
+def _ready_result(response):
+    pending = PendingResult(None)
+    pending.set(response)
+    return pending
+
+
+def load_classifier(classifier=None, model=None):
+    """
+    Creates a classifier by its name (module:ClassName, created without arguments)
+    or loads a whole classifier saved with anaphoralib.persistence.save_model(classifier, path).
+    Models saved with BaseClassifier.save or AnaphoraMLResolutor.save_model contain only an estimator,
+    they cannot resolve documents and are rejected
+    """
+    if model:
+        loaded = persistence.load_model(model)
+        name = persistence.read_header(model)['model_class']
+    else:
+        module_name, class_name = classifier.split(':')
+        loaded = getattr(importlib.import_module(module_name), class_name)()
+        name = classifier
+
+    if not hasattr(loaded, 'resolve'):
+        raise ValueError('{} has no resolve method: a classifier such as MentionPairClassifier is needed '
+                         '(an estimator saved without its classifier cannot be served)'.format(name))
+    return loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Long-running coreference resolution service')
+    parser.add_argument('--classifier', help='a classifier class: module:ClassName')
+    parser.add_argument('--model', help='a directory with a whole classifier (e.g. a MentionPairClassifier) '
+                                        'saved with anaphoralib.persistence.save_model')
+    parser.add_argument('--tagset', default='anaphoralib.tagsets.multeast', help='a tagset module')
+    parser.add_argument('--http', type=int, help='serve HTTP on this port instead of stdin/stdout')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--max-wait', type=float, default=0.005, help='seconds to wait for a batch to fill')
+    parser.add_argument('--no-parses', action='store_true', help='find groups without syntax')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='seconds to wait for a response to a document before answering with an error')
+    args = parser.parse_args()
+
+    if not args.classifier and not args.model:
+        parser.error('either --classifier or --model is required')
+
+    try:
+        classifier = load_classifier(args.classifier, args.model)
+    except ValueError as e:
+        parser.error(str(e))
+
+    service = ResolutionService(importlib.import_module(args.tagset),
+                                classifier,
+                                batch_size=args.batch_size,
+                                max_wait=args.max_wait,
+                                use_parses=not args.no_parses)
+
+    if args.http:
+        serve_http(service, args.host, args.http, args.timeout)
+    else:
+        serve_stdio(service, timeout=args.timeout)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,28 +2,79 @@
 
 """
 This is the recommended way to check against part of speech. Add a lambda-function for the desired POS
-and use it in your code in the following way: pos_filters['desired_pos'](word), where word is a list
+to tag_filters and use it in your code in the following way: pos_filters['desired_pos'](word), where word is a list
 """
-pos_filters = {
-    'noun': lambda x: x.tag.startswith('N') or x.tag.startswith('PP'),
-    'adj': lambda x: x.tag.startswith('A'),# or x.tag.startswith('R'),
-    'properNoun': lambda x: x.tag.startswith('Np'),
-    'pronoun': lambda x: x.tag.startswith('P') and x.tag != 'P-----r',
-    'coref_pronoun': lambda x: x.wordform[0].lower() in coref_pronouns and x.tag.startswith('P'),
-    'comma': lambda x: x.tag.startswith(','),
-    'prep': lambda x: x.tag.startswith('S'),
-    'insideQuote': lambda x: x.tag.startswith('Fra') or x.tag.startswith('QuO'),
-    'closeQuote': lambda x: x.tag.startswith('Frc'),
-    #'firstName': lambda x: x.tag.startswith('N') and x.tag[6] == 'N',
-    #'secondName': lambda x: (x.tag.startswith('N') and x.tag[6] in ['F', 'S']) or (
-    #    x.tag.startswith('A') and x.tag[5] in ['F', 'S']),  # 'conj': lambda x: x.tag == 'C0' or x.tag == 'Fc'
-    'conj': lambda x: x.tag.startswith('C'),
-    'quant': lambda x: x.tag.startswith('M'),
-    'verb': lambda x: x.tag.startswith('V'),
-    'interjection': lambda x: x.tag.startswith('I'),
-    'punctuation': lambda x: not x.tag[0].isalpha() or x.tag == 'SENT'
+
+import collections
+
+tag_filters = {
+    'noun': lambda tag: tag.startswith('N') or tag.startswith('PP'),
+    'adj': lambda tag: tag.startswith('A'),# or tag.startswith('R'),
+    'properNoun': lambda tag: tag.startswith('Np'),
+    'pronoun': lambda tag: tag.startswith('P') and tag != 'P-----r',
+    'comma': lambda tag: tag.startswith(','),
+    'prep': lambda tag: tag.startswith('S'),
+    'insideQuote': lambda tag: tag.startswith('Fra') or tag.startswith('QuO'),
+    'closeQuote': lambda tag: tag.startswith('Frc'),
+    #'firstName': lambda tag: tag.startswith('N') and tag[6] == 'N',
+    #'secondName': lambda tag: (tag.startswith('N') and tag[6] in ['F', 'S']) or (
+    #    tag.startswith('A') and tag[5] in ['F', 'S']),  # 'conj': lambda tag: tag == 'C0' or tag == 'Fc'
+    'conj': lambda tag: tag.startswith('C'),
+    'quant': lambda tag: tag.startswith('M'),
+    'verb': lambda tag: tag.startswith('V'),
+    'interjection': lambda tag: tag.startswith('I'),
+    'punctuation': lambda tag: not tag[:1].isalpha() or tag == 'SENT'
+}
+
+pos_masks = {pos: 1 << i for i, pos in enumerate(sorted(tag_filters))}
+"""Bit of each POS class in DecodedTag.pos"""
+
+features = {
+    'N': ['proper', 'gender', 'number', 'case', 'animate', 'case2'],
+    'V': ['aux', 'vform', 'tense', 'person', 'number', 'gender', 'voice', 'definiteness', 'aspect', 'case'],
+    'A': ['type', 'degree', 'gender', 'number', 'case', 'definiteness'],
+    'P': ['type', 'person', 'gender', 'number', 'case', 'synt_type', 'animate']
 }
 
+feature_positions = {name: i for i, name in enumerate(sorted(set(name for pos in features for name in features[pos])))}
+"""Position of each feature in DecodedTag.grammemes"""
+
+DecodedTag = collections.namedtuple('DecodedTag', ['pos', 'grammemes'])
+
+_decoded_tags = {}
+
+
+def decode_tag(tag):
+    """
+    Decodes a tag once and caches the result
+    :return: DecodedTag: pos is a bitmask of POS classes (see pos_masks), grammemes is a tuple with
+    a value of each feature (see feature_positions) or None if the tag does not have it
+    """
+    decoded = _decoded_tags.get(tag)
+    if decoded is None:
+        pos_mask = 0
+        for pos in tag_filters:
+            if tag_filters[pos](tag):
+                pos_mask |= pos_masks[pos]
+
+        grammemes = [None] * len(feature_positions)
+        for i, name in enumerate(features.get(tag[:1], [])):
+            if i + 1 < len(tag):
+                grammemes[feature_positions[name]] = tag[i + 1]
+
+        decoded = _decoded_tags[tag] = DecodedTag(pos_mask, tuple(grammemes))
+    return decoded
+
+
+def _pos_filter(pos):
+    mask = pos_masks[pos]
+    return lambda x: bool(decode_tag(x.tag).pos & mask)
+
+
+"""Tests of part of speech of a word, tags are decoded only once (see decode_tag)"""
+pos_filters = {pos: _pos_filter(pos) for pos in tag_filters}
+pos_filters['coref_pronoun'] = lambda x: x.wordform[0].lower() in coref_pronouns and x.tag.startswith('P')
+
 agreement_tests = {
     'A+N': lambda adj, noun: noun.tag == 'Nc' or (adj.tag[4] == noun.tag[3] and adj.tag[2] == 'p'),
     'Va+N': lambda verb, noun: verb.tag.startswith('Vmp') and
@@ -73,6 +124,20 @@ agreement_filters = {
         agreement_tests['N+NProper'](noun, noun_prop)) else None
 }
 
+"""
+Which part of a group of each agreement filter contains the head of the group: the head of the left part
+or the head of the right part (shifted by the size of the left part)
+"""
+agreement_heads = {
+    'adjNoun': 'right',
+    'vadjNoun': 'right',
+    'pradjNoun': 'right',
+    'quantNoun': 'right',
+    'quantGen': 'left',
+    'nounGen': 'left',
+    'nounNounProp': 'right'
+}
+
 
 np_conjunction = lambda word1, conj, word2: 'N{p}-p{c}{a}{c2}'.format(p=word1.tag[1],
                                                                       c=word1.tag[4],
@@ -82,19 +147,10 @@ np_conjunction = lambda word1, conj, word2: 'N{p}-p{c}{a}{c2}'.format(p=word1.ta
     and pos_filters['noun'](word2)
     and (pos_filters['conj'](conj) or pos_filters['comma'](conj))) else None
 
-features = {
-    'N': ['proper', 'gender', 'number', 'case', 'animate', 'case2'],
-    'V': ['aux', 'vform', 'tense', 'person', 'number', 'gender', 'voice', 'definiteness', 'aspect', 'case'],
-    'A': ['type', 'degree', 'gender', 'number', 'case', 'definiteness'],
-    'P': ['type', 'person', 'gender', 'number', 'case', 'synt_type', 'animate']
-}
-
 
 def extract_feature(name, word):
-    pos = word.tag[0]
-    return word.tag[features[pos].index(name) + 1] \
-        if pos in features and name in features[pos] and features[pos].index(name) + 1 < len(word.tag) \
-        else None
+    position = feature_positions.get(name)
+    return decode_tag(word.tag).grammemes[position] if position is not None else None
 
 
 def is_np_dependency(w1, w2, rel):
@@ -1,7 +1,10 @@
 
 def same_grammemmes(name, words, tagset):
-
-    feature_values = [tagset.extract_feature(name, word) for word in words]
+    if hasattr(tagset, 'decode_tag') and name in tagset.feature_positions:
+        position = tagset.feature_positions[name]
+        feature_values = [tagset.decode_tag(word.tag).grammemes[position] for word in words]
+    else:
+        feature_values = [tagset.extract_feature(name, word) for word in words]
     if None in feature_values:
         feature_values.remove(None)
     if '-' in feature_values:
@@ -7,6 +7,8 @@ import itertools
 
 @python_2_unicode_compatible
 class Word(object):
+    n_words = 1
+
     def __init__(self, wordform, lemma, tag, prob, offset, length):
         self.wordform = wordform if isinstance(wordform, list) else [wordform]
         self.lemma = lemma if isinstance(lemma, list) else [lemma]
@@ -48,6 +50,10 @@ class Group(Word):
         self.words = words[:]
         self.head = head
 
+    @property
+    def n_words(self):
+        return len(self.words)
+
     def iter_groups(self):
         yield self #(self.offset, self.length, self.tag, True)
 
@@ -59,18 +65,134 @@ class Group(Word):
         return self.words[self.head].offset
 
 
+@python_2_unicode_compatible
+class SpanGroup(object):
+    """
+    A compact group that does not copy words: it refers to a range of word indices in a text
+    (or to a tuple of indices if the group is not contiguous) and its head. Wordforms, lemmas and tags
+    are taken from the text when they are accessed. Has the same interface as Group
+    """
+    __slots__ = ('text', 'start', 'end', 'indices', 'head', 'tag', 'type')
+
+    prob = 1.0
+
+    def __init__(self, text, start, end, head, tag, type, indices=None):
+        self.text = text
+        self.start = start
+        self.end = end
+        self.indices = tuple(indices) if indices is not None else None
+        self.head = head
+        self.tag = tag
+        self.type = type
+
+    @classmethod
+    def from_indices(cls, text, indices, head, tag, type):
+        """Creates a group of words with given indices in a text, head is an index of a head in indices"""
+        indices = list(indices)
+        contiguous = indices == list(range(indices[0], indices[0] + len(indices)))
+        return cls(text, indices[0], indices[-1] + 1, head, tag, type, indices=None if contiguous else indices)
+
+    @property
+    def word_indices(self):
+        return self.indices if self.indices is not None else range(self.start, self.end)
+
+    @property
+    def words(self):
+        return [self.text[i] for i in self.word_indices]
+
+    @property
+    def n_words(self):
+        return len(self.indices) if self.indices is not None else self.end - self.start
+
+    @property
+    def wordform(self):
+        return [word.wordform[0] for word in self.words]
+
+    @property
+    def lemma(self):
+        return [word.lemma[0] for word in self.words]
+
+    @property
+    def tags(self):
+        return [word.tag for word in self.words]
+
+    @property
+    def offset(self):
+        return self.text[self.start].offset
+
+    @property
+    def length(self):
+        last_word = self.text[self.end - 1]
+        return last_word.offset + last_word.length - self.offset
+
+    def head_offset(self):
+        return self.text[self.word_indices[self.head]].offset
+
+    def iter_groups(self):
+        yield self
+
+        for word in self.words:
+            for g in word.iter_groups():
+                yield g
+
+    def __str__(self):
+        return u'{wordform}:{lemma}({tag}, {offset})'.format(lemma=u' '.join(self.lemma),
+                                                             wordform=u' '.join(self.wordform),
+                                                             tag=self.tag,
+                                                             offset=self.offset)
+
+    def __repr__(self):
+        return str(self)
+
+
+_agreement_tables = {}
+
+
+def agreement_rule(word1, word2, tagset):
+    """
+    Returns the name of the first agreement filter of a tagset that groups two words and the tag
+    of the group (or (None, None)). Agreement filters depend only on tags of words, so the decision is made
+    once for each pair of tags and is stored in a table of a tagset
+    """
+    table = _agreement_tables.get(tagset)
+    if table is None:
+        table = _agreement_tables[tagset] = {}
+
+    key = (word1.tag, word2.tag)
+    if key not in table:
+        rule = None
+        group = None
+        for agr in tagset.agreement_filters:
+            try:
+                res = tagset.agreement_filters[agr](word1, word2)
+            except IndexError:
+                print (word1, word2)
+                raise
+            if res:
+                rule = agr
+                group = res[0]
+                break
+        table[key] = (rule, group)
+
+    return table[key]
+
+
+def agreement_head(rule, word1, word2, tagset):
+    """
+    Returns the index of the head of a group of two words made by an agreement rule.
+    The head is the head of the left or the right part (see tagset.agreement_heads), so it depends
+    only on sizes of the parts; for tagsets without agreement_heads the filter is evaluated again
+    """
+    heads = getattr(tagset, 'agreement_heads', None)
+    if heads is None or rule not in heads:
+        return tagset.agreement_filters[rule](word1, word2)[1]
+    return word1.head if heads[rule] == 'left' else word1.n_words + word2.head
+
+
 def try_group(word1, word2, tagset):
-    group = None
-    head = None
-    for agr in tagset.agreement_filters:
-        try:
-            res = tagset.agreement_filters[agr](word1, word2)
-        except IndexError:
-            print (word1, word2)
-            raise
-        if res:
-            group, head = res
-            break
+    rule, group = agreement_rule(word1, word2, tagset)
+    if not rule or not group:
+        return None
 
     return Group(wordform=word1.wordform + word2.wordform,
                  lemma=word1.lemma + word2.lemma,
@@ -81,9 +203,20 @@ def try_group(word1, word2, tagset):
                  length=(word2.offset + word2.length) - word1.offset,
                  words=(word1.words if word1.type != 'word' else [word1]) +
                        (word2.words if word2.type != 'word' else [word2]),
-                 head=head,
-                 type='agr')\
-        if group else None
+                 head=agreement_head(rule, word1, word2, tagset),
+                 type='agr')
+
+
+def try_span_group(text, start, end, word1, word2, tagset):
+    """
+    The same as try_group, but creates a SpanGroup of words from start to end (exclusive) of a text.
+    word1 and word2 should be the left and the right parts of this range
+    """
+    rule, group = agreement_rule(word1, word2, tagset)
+    if not rule or not group:
+        return None
+
+    return SpanGroup(text, start, end, agreement_head(rule, word1, word2, tagset), group, 'agr')
 
 
 def try_conjunction(word1, conj, word2, tagset):
@@ -98,39 +231,63 @@ def try_conjunction(word1, conj, word2, tagset):
                  words=(word1.words if word1.type != 'word' else [word1]) +
                        (conj.words if conj.type != 'word' else [conj]) +
                        (word2.words if word2.type != 'word' else [word2]),
-                 head=len(word1.tags),
+                 head=word1.n_words,
                  type='conj')\
         if tag else None
 
 
-def find_groups_syntax(text, tagset, parses):
+def find_groups_syntax(text, tagset, parses, compact=False):
+    """
+    Extracts NP groups from dependency trees: a group consists of an NP head and all its dependants
+    connected with NP dependencies (see tagset.is_np_dependency).
+    Subtrees are built bottom-up without recursion, each one is computed only once and reused by all groups
+    that contain it
+    :param compact: if True, groups are created as SpanGroup objects
+    """
     nps = []
 
-    def get_dependencies_recursive(i):
-        res = {i}
-        if i in dep_ind:
-            for j in dep_ind[i]:
-                if tagset.is_np_dependency(text[i], text[j[0]], j[1]):
-                    res |= get_dependencies_recursive(j[0])
-        return res
-
-    def build_dependency_index():
-        dependencies = collections.defaultdict(set)
-        for w2_ind, word2 in enumerate(text):
-            w1_ind = parses[w2_ind][0] - 1
-            rel = parses[w2_ind][1]
-
-            if w1_ind != -1:
-                dependencies[w1_ind].add((w2_ind, rel))
-        return dependencies
-
-    dep_ind = build_dependency_index()
+    dependencies = collections.defaultdict(list)
+    for w2_ind, word2 in enumerate(text):
+        w1_ind = parses[w2_ind][0] - 1
+        rel = parses[w2_ind][1]
+
+        if 0 <= w1_ind < len(text) and tagset.is_np_dependency(text[w1_ind], word2, rel):
+            dependencies[w1_ind].append(w2_ind)
+
+    subtrees = {}
+    expanded = set()
+
+    def build_subtree(root):
+        # iterative post-order traversal: a node is finished when all its dependants are finished
+        stack = [root]
+        while stack:
+            node = stack[-1]
+            if node in subtrees:
+                stack.pop()
+                continue
+
+            pending = [child for child in dependencies[node] if child not in subtrees]
+            if pending and node not in expanded:
+                expanded.add(node)
+                stack.extend(pending)
+                continue
+
+            stack.pop()
+            # dependants that are not finished at this point are on a cycle, they are skipped
+            subtrees[node] = sorted(itertools.chain([node], *(subtrees[child] for child in dependencies[node]
+                                                               if child in subtrees)))
+
     for i, word in enumerate(text):
         if tagset.is_np_head(word):
-            np_words = sorted(get_dependencies_recursive(i))
+            build_subtree(i)
+            np_words = subtrees[i][:]
             while np_words and tagset.pos_filters['punctuation'](text[np_words[-1]]):
                 np_words.pop()
             np_head = np_words.index(i)
+            if compact:
+                nps.append(SpanGroup.from_indices(text, np_words, np_head, text[i].tag, 'agr'))
+                continue
+
             np_words = [text[w] for w in np_words]
             nps.append(Group(wordform=list(itertools.chain.from_iterable(w.wordform for w in np_words)),
                              lemma=list(itertools.chain.from_iterable(w.lemma for w in np_words)),
@@ -146,10 +303,56 @@ def find_groups_syntax(text, tagset, parses):
     return nps
 
 
-def find_groups(text, tagset, parses=None):
+def find_groups(text, tagset, parses=None, method='stack', compact=False):
+    """
+    Finds NP groups in a text
+    :param parses: a list of (head, rel) tuples, if provided, groups are extracted from dependency trees
+    :param method: 'stack' for a linear shift-reduce chunker or 'restart' for the original algorithm
+    that rescans the text after each merge; both produce the same groups
+    :param compact: if True, groups are created as SpanGroup objects referring to words of the text
+    (supported by the 'stack' method and syntax-based grouping)
+    :return: a list of groups (and words that are not in any group)
+    """
     if parses:
-        return find_groups_syntax(text, tagset, parses)
+        return find_groups_syntax(text, tagset, parses, compact)
+
+    if method == 'restart':
+        if compact:
+            raise ValueError('Compact groups are not supported by the restart method')
+        groups = _find_groups_restart(text, tagset)
+    elif method == 'stack':
+        groups = _find_groups_stack(text, tagset, compact)
+    else:
+        raise ValueError('Unknown grouping method: {}'.format(method))
+
+    return [group for group in groups if group.tag[0].isalpha()]
 
+
+def _find_groups_stack(text, tagset, compact=False):
+    # The restart algorithm always merges the leftmost pair that could be merged. Since the pairs
+    # on the stack could not be merged, the leftmost candidate is always at the top of the stack,
+    # so the same merges are made in the same order, but each word is shifted only once
+    groups = []
+    starts = []
+
+    for i, word in enumerate(text):
+        groups.append(word)
+        starts.append(i)
+        while len(groups) > 1:
+            if compact:
+                group = try_span_group(text, starts[-2], i + 1, groups[-2], groups[-1], tagset)
+            else:
+                group = try_group(groups[-2], groups[-1], tagset)
+            if not group:
+                break
+            groups.pop()
+            starts.pop()
+            groups[-1] = group
+
+    return groups
+
+
+def _find_groups_restart(text, tagset):
     groups = text[:]
     was_merge = True
 
@@ -176,10 +379,15 @@ def find_groups(text, tagset, parses=None):
     #
     #            break
 
-    return [group for group in groups if group.tag[0].isalpha()]
+    return groups
 
 
 def find_mentions(text, tagset):
+    if hasattr(text, 'filter_mask'):
+        # columnar texts evaluate filters once per distinct word instead of once per token
+        mask = text.filter_mask(tagset.pos_filters['noun']) | text.filter_mask(tagset.pos_filters['coref_pronoun'])
+        return [text[i] for i in mask.nonzero()[0]]
+
     return [word for word in text
             if tagset.pos_filters['noun'](word)
             or tagset.pos_filters['coref_pronoun'](word)]
@@ -0,0 +1,88 @@
+# -!- coding: utf-8 -!-
+from __future__ import unicode_literals
+
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from anaphoralib.experiments import featurestore
+
+Mention = collections.namedtuple('Mention', 'offset length')
+
+FEATURES = ['distance', 'length']
+
+
+def make_pairs(n_pairs):
+    return [(Mention(i * 10, 3), Mention(i * 10 + 5, i + 1)) for i in range(n_pairs)]
+
+
+class FeaturesCounter(object):
+    def __init__(self):
+        self.n_computed = 0
+
+    def __call__(self, pairs):
+        self.n_computed += len(pairs)
+        return [[pair[1].offset - pair[0].offset, pair[1].length] for pair in pairs]
+
+
+class PairFeatureStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        pairs = make_pairs(25)
+        compute = FeaturesCounter()
+        expected = np.array(compute(pairs), dtype=float)
+        compute.n_computed = 0
+
+        # cold store: everything is computed
+        with featurestore.PairFeatureStore(self.tmp_dir, 'Classifier', FEATURES, chunk_size=10) as store:
+            np.testing.assert_array_equal(store.get_features(1, pairs[:15], compute), expected[:15])
+            np.testing.assert_array_equal(store.get_features(1, pairs, compute), expected)
+            self.assertEqual(compute.n_computed, 25)
+            self.assertEqual(store.stats['misses'], 25)
+            self.assertEqual(store.stats['hits'], 15)
+
+        # warm reload: everything is loaded from disk
+        store = featurestore.PairFeatureStore(self.tmp_dir, 'Classifier', FEATURES, chunk_size=10, cache_size=1)
+        self.assertEqual(len(store), 25)
+        self.assertEqual(store.n_features, 2)
+        np.testing.assert_array_equal(store.get_features(1, pairs[::-1], compute), expected[::-1])
+        self.assertEqual(compute.n_computed, 25)
+        self.assertEqual(store.stats['hits'], 25)
+        self.assertEqual(store.stats['misses'], 0)
+
+        # the same pairs of another document are new
+        store.get_features(2, pairs[:3], compute)
+        self.assertEqual(compute.n_computed, 28)
+
+    def test_feature_set_change(self):
+        pairs = make_pairs(5)
+        compute = FeaturesCounter()
+        with featurestore.PairFeatureStore(self.tmp_dir, 'Classifier', FEATURES) as store:
+            store.get_features(1, pairs, compute)
+
+        with featurestore.PairFeatureStore(self.tmp_dir, 'Classifier', FEATURES + ['gender']) as new_store:
+            self.assertNotEqual(new_store.path, store.path)
+            self.assertEqual(len(new_store), 0)
+            new_store.get_features(1, pairs, compute)
+        self.assertEqual(compute.n_computed, 10)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), sorted([os.path.basename(store.path),
+                                                                   os.path.basename(new_store.path)]))
+
+    def test_wrong_number_of_vectors(self):
+        store = featurestore.PairFeatureStore(self.tmp_dir, 'Classifier', FEATURES)
+        with self.assertRaises(ValueError):
+            store.get_features(1, make_pairs(3), lambda pairs: [[0.0, 1.0]] * (len(pairs) - 1))
+        self.assertEqual(len(store), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
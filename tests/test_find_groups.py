@@ -0,0 +1,77 @@
+# -!- coding: utf-8 -!-
+from __future__ import unicode_literals
+
+import random
+import unittest
+
+from anaphoralib import utils
+from anaphoralib.corpora import columnar
+from anaphoralib.tagsets import multeast
+
+TAGS = ['Ncmsnn', 'Ncfsgn', 'Ncnpgn', 'Ncmpan', 'Npmsny', 'Npfsgy', 'Afpmsnf', 'Afpfsgf', 'Afpnpgf',
+        'Vmip3s-a-e', 'Vmpp-s-pfpe', 'Sp-g', 'C', ',', 'Pp3msnn', 'Pp3fsan', 'Px---a', 'Mc--g', 'Mo-msn',
+        'Q', 'R', 'I', 'SENT']
+
+WORDFORMS = {'N': ['дом', 'мама', 'Иван', 'стол'], 'A': ['красный', 'новый'], 'V': ['идти', 'сделанный'],
+             'P': ['он', 'она', 'его', 'себя', 'который'], 'M': ['два', 'первый'], 'S': ['в'], 'C': ['и'],
+             ',': [','], 'Q': ['не'], 'R': ['быстро'], 'I': ['ой'], 'SENT': ['.']}
+
+
+def random_text(rnd, n_words):
+    words = []
+    offset = 0
+    for _ in range(n_words):
+        tag = rnd.choice(TAGS)
+        wordform = rnd.choice(WORDFORMS['SENT' if tag == 'SENT' else tag[0]])
+        words.append(utils.Word(wordform, wordform, tag, 1.0, offset, len(wordform)))
+        offset += len(wordform) + 1
+    return words
+
+
+def describe(groups):
+    return [(group.type, group.tag, group.head_offset(), group.offset, group.length,
+             list(group.wordform), list(group.lemma),
+             [word.offset for word in group.words] if group.type != 'word' else [group.offset])
+            for group in groups]
+
+
+class FindGroupsTest(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(0)
+        self.texts = [random_text(rnd, rnd.randint(0, 300)) for _ in range(50)]
+        vocabularies = columnar.Vocabularies()
+        self.columnar_texts = [columnar.ColumnarText.from_words(text, vocabularies) for text in self.texts]
+
+    def test_stack_equals_restart(self):
+        for text in self.texts:
+            expected = describe(utils.find_groups(text, multeast, method='restart'))
+            self.assertEqual(describe(utils.find_groups(text, multeast, method='stack')), expected)
+            self.assertEqual(describe(utils.find_groups(text, multeast, method='stack', compact=True)), expected)
+
+    def test_stack_equals_restart_columnar(self):
+        for text, columnar_text in zip(self.texts, self.columnar_texts):
+            expected = describe(utils.find_groups(text, multeast, method='restart'))
+            self.assertEqual(describe(utils.find_groups(columnar_text, multeast, method='restart')), expected)
+            self.assertEqual(describe(utils.find_groups(columnar_text, multeast, method='stack')), expected)
+            self.assertEqual(describe(utils.find_groups(columnar_text, multeast, method='stack', compact=True)),
+                             expected)
+
+    def test_groups_are_found(self):
+        n_groups = sum(1 for text in self.texts for group in utils.find_groups(text, multeast, method='restart')
+                       if group.type != 'word')
+        self.assertGreater(n_groups, 0)
+
+    def test_n_words(self):
+        for text, columnar_text in zip(self.texts, self.columnar_texts):
+            for groups in (utils.find_groups(text, multeast, method='restart'),
+                           utils.find_groups(columnar_text, multeast, method='stack', compact=True)):
+                for group in groups:
+                    self.assertEqual(group.n_words, len(group.tags))
+
+    def test_compact_restart_is_not_supported(self):
+        with self.assertRaises(ValueError):
+            utils.find_groups(self.texts[0], multeast, method='restart', compact=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
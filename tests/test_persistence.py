@@ -0,0 +1,83 @@
+# -!- coding: utf-8 -!-
+from __future__ import unicode_literals
+
+import collections
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from anaphoralib import persistence
+
+
+class Transposed(object):
+    """Its state is a new array that nothing references after it is pickled"""
+    def __init__(self, values):
+        self.values = values
+
+    def __getstate__(self):
+        return self.values.T.copy()
+
+    def __setstate__(self, state):
+        self.values = state.T
+
+
+class PersistenceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'model')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_shared_arrays(self):
+        coef = np.arange(12, dtype=np.float64).reshape(3, 4)
+        model = collections.OrderedDict([('coef', coef), ('same_coef', coef), ('intercept', np.ones(3)),
+                                         ('labels', np.array(['a', None], dtype=object)), ('name', 'model')])
+        header = persistence.save_model(model, self.path, metadata={'tagset': 'multeast'})
+        self.assertEqual(len(header['arrays']), 2)
+        self.assertEqual(persistence.read_header(self.path)['metadata'], {'tagset': 'multeast'})
+
+        loaded = persistence.load_model(self.path)
+        self.assertIs(loaded['coef'], loaded['same_coef'])
+        self.assertIsInstance(loaded['coef'], np.memmap)
+        self.assertFalse(loaded['coef'].flags.writeable)
+        np.testing.assert_array_equal(loaded['coef'], coef)
+        np.testing.assert_array_equal(loaded['intercept'], np.ones(3))
+        self.assertEqual(list(loaded['labels']), ['a', None])
+        self.assertEqual(loaded['name'], 'model')
+
+        loaded = persistence.load_model(self.path, mmap=False)
+        self.assertNotIsInstance(loaded['coef'], np.memmap)
+        np.testing.assert_array_equal(loaded['coef'], coef)
+
+    def test_temporary_arrays(self):
+        model = [Transposed(np.full((2, 3), i)) for i in range(20)]
+        persistence.save_model(model, self.path)
+
+        loaded = persistence.load_model(self.path)
+        for i, item in enumerate(loaded):
+            np.testing.assert_array_equal(item.values, np.full((2, 3), i))
+
+    def test_lazy_model(self):
+        persistence.save_model(collections.OrderedDict([('coef', np.arange(3))]), self.path)
+        lazy = persistence.load_model(self.path, lazy=True)
+        self.assertIsNone(lazy.model_)
+
+        unpickled = pickle.loads(pickle.dumps(lazy, protocol=2))
+        self.assertIsNone(unpickled.model_)
+        self.assertEqual(list(unpickled.keys()), ['coef'])
+        self.assertIsInstance(unpickled.load()['coef'], np.memmap)
+        self.assertIsNone(lazy.model_)
+
+    def test_not_a_folder(self):
+        open(self.path, 'w').close()
+        with self.assertRaises(ValueError):
+            persistence.save_model({}, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
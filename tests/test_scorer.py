@@ -0,0 +1,121 @@
+# -!- coding: utf-8 -!-
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from anaphoralib import scorer
+
+# The example of Pradhan et al. (2014), "Scoring Coreference Partitions of Predicted Mentions:
+# A Reference Implementation": key {a b c} {d e f g}, response {a b} {c d} {f g h i}.
+# Expected scores are rounded the way scorer.pl prints them; test_reference_scorer checks them
+# against scorer.pl itself if it is available
+TOKENS = 'abcdefghi'
+KEY = [['a', 'b', 'c'], ['d', 'e', 'f', 'g']]
+RESPONSE = [['a', 'b'], ['c', 'd'], ['f', 'g', 'h', 'i']]
+
+EXPECTED = {
+    'muc': {'Identification of Mentions': (85.71, 75.0, 80.0),
+            'Coreference': (40.0, 40.0, 40.0)},
+    'bcub': {'Coreference': (41.67, 50.0, 45.45)},
+    'ceafm': {'Coreference': (57.14, 50.0, 53.33)},
+    'ceafe': {'Coreference': (65.0, 43.33, 52.0)},
+    'blanc': {'Coreference links': (22.22, 25.0, 23.53),
+              'Non-coreference links': (66.67, 40.0, 50.0),
+              'BLANC': (44.44, 32.5, 36.76)},
+    'lea': {'Coreference': (23.81, 33.33, 27.78)}
+}
+
+
+def write_conll(filename, clusters):
+    chains = {mention: i_cluster for i_cluster, cluster in enumerate(clusters) for mention in cluster}
+    with io.open(filename, 'w', encoding='utf-8') as out_file:
+        out_file.write('#begin document (test);\n')
+        for i_token, token in enumerate(TOKENS):
+            mark = '({})'.format(chains[token]) if token in chains else '-'
+            out_file.write('test\t0\t{}\t{}\t{}\n'.format(i_token, token, mark))
+        out_file.write('\n#end document\n')
+
+
+class ScorerTest(unittest.TestCase):
+    def assertScores(self, scores, places=2):
+        self.assertIn('muc', scores)
+        for metric in EXPECTED:
+            if metric not in scores:
+                # older versions of scorer.pl do not compute LEA
+                continue
+            for name, expected in EXPECTED[metric].items():
+                for value, expected_value in zip(scores[metric][name], expected):
+                    self.assertIsInstance(value, float)
+                    self.assertAlmostEqual(value, expected_value, places=places, msg='{} {}'.format(metric, name))
+
+    def test_reference_example(self):
+        self.assertScores(scorer.score([KEY], [RESPONSE]))
+
+    def test_single_metric(self):
+        scores = scorer.score([KEY], [RESPONSE], 'ceafe')
+        self.assertEqual(list(scores), ['ceafe'])
+        self.assertAlmostEqual(scores['ceafe']['Coreference'][2], 52.0, places=2)
+
+    def test_unknown_metric(self):
+        with self.assertRaises(ValueError):
+            scorer.score([KEY], [RESPONSE], 'ceaf')
+        with self.assertRaises(ValueError):
+            scorer.score([KEY], [RESPONSE], ['muc', 'ceaf'])
+
+    def test_perfect_response(self):
+        scores = scorer.score([KEY], [KEY])
+        for metric in scorer.METRICS:
+            name = 'BLANC' if metric == 'blanc' else 'Coreference'
+            self.assertEqual(scores[metric][name], (100.0, 100.0, 100.0))
+
+    def test_get_clusters_uses_mention_spans(self):
+        # groups 2 and 3 have the same borders, so they are the same mention in the CoNLL format
+        groups = {1: {'tokens_shifts': [0]},
+                  2: {'tokens_shifts': [10, 15, 20]},
+                  3: {'tokens_shifts': [10, 20]},
+                  4: {'tokens_shifts': [30]}}
+        chains = {1: [1, 2], 2: [3, 4]}
+        self.assertEqual(scorer.get_clusters(groups, chains), [[(0, 0), (10, 20)], [(30, 30)]])
+
+    def test_reference_scorer_output(self):
+        # a script that prints scores the same way scorer.pl does
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            script_filename = os.path.join(tmp_dir, 'scorer.py')
+            with io.open(script_filename, 'w', encoding='utf-8') as out_file:
+                out_file.write('print("METRIC muc:")\n'
+                               'print("Identification of Mentions: Recall: (6 / 7) 85.71%\\tPrecision: (6 / 8) 75%'
+                               '\\tF1: 80%")\n'
+                               'print("Coreference: Recall: (2 / 5) 40%\\tPrecision: (2 / 5) 40%\\tF1: 40%")\n')
+
+            scores = scorer.run_reference_scorer('key.txt', 'response.txt', 'muc', script_filename, sys.executable)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(scores, {'muc': {'Identification of Mentions': (85.71, 75.0, 80.0),
+                                          'Coreference': (40.0, 40.0, 40.0)}})
+
+    @unittest.skipUnless(os.environ.get('SCORER_PL'), 'set SCORER_PL to a path to scorer.pl to compare with it')
+    def test_reference_scorer(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            key_filename = os.path.join(tmp_dir, 'key.txt')
+            response_filename = os.path.join(tmp_dir, 'response.txt')
+            write_conll(key_filename, KEY)
+            write_conll(response_filename, RESPONSE)
+
+            reference_scores = scorer.run_reference_scorer(key_filename, response_filename, 'all',
+                                                           os.environ['SCORER_PL'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertScores(reference_scores)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+# -!- coding: utf-8 -!-
+from __future__ import unicode_literals
+
+import io
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+
+from anaphoralib import persistence
+from anaphoralib import service
+from anaphoralib.experiments import mentionpair
+from anaphoralib.tagsets import multeast
+
+WORDS = [('мама', 'Ncfsnn'), ('мыла', 'Vmis-sfa-e'), ('красную', 'Afpfsaf'), ('раму', 'Ncfsan'), ('.', 'SENT'),
+         ('она', 'Pp3fsnn'), ('устала', 'Vmis-sfa-p'), ('.', 'SENT')]
+
+
+def make_document(doc_id):
+    tokens = []
+    shift = 0
+    for wordform, tag in WORDS:
+        tokens.append({'token': wordform, 'lemma': wordform, 'gram': tag, 'shift': shift, 'length': len(wordform)})
+        shift += len(wordform) + 1
+    return {'id': doc_id, 'tokens': tokens}
+
+
+class SameGenderClassifier(mentionpair.MentionPairClassifier):
+    def pair_coreferent(self, pair, groups, words, parse):
+        return multeast.extract_feature('gender', pair[0]) == multeast.extract_feature('gender', pair[1])
+
+
+class SlowClassifier(mentionpair.MentionPairClassifier):
+    def __init__(self):
+        super(SlowClassifier, self).__init__()
+        self.release = threading.Event()
+
+    def resolve_batch(self, texts, return_heads_only=False):
+        self.release.wait()
+        return super(SlowClassifier, self).resolve_batch(texts, return_heads_only)
+
+
+class ResolutionServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.service = service.ResolutionService(multeast, SameGenderClassifier(), max_wait=0.001)
+
+    def test_resolve(self):
+        response = self.service.resolve(make_document('doc'), timeout=10)
+        self.assertEqual(response['id'], 'doc')
+        self.assertNotIn('error', response)
+        self.assertEqual(len(response['chains']), 1)
+        chain = list(response['chains'].values())[0]
+        self.assertEqual([response['groups'][str(group_id)]['tokens_shifts'] for group_id in chain],
+                         [[0], [10, 18], [25]])
+
+    def test_malformed_documents(self):
+        malformed = [{'id': 1}, {'id': 2, 'tokens': None}, {'id': 3, 'tokens': 5}, {'id': 4, 'tokens': 'abc'},
+                     [1, 2], 'document', None]
+        for document in malformed:
+            response = self.service.resolve(document, timeout=10)
+            self.assertIn('error', response)
+            self.assertEqual(response['id'], document.get('id') if isinstance(document, dict) else None)
+
+        self.assertTrue(self.service.worker.is_alive())
+        response = self.service.resolve(make_document('valid'), timeout=10)
+        self.assertNotIn('error', response)
+
+        stats = self.service.stats()
+        self.assertEqual(stats['documents'], len(malformed) + 1)
+        self.assertEqual(stats['errors'], len(malformed))
+        self.assertEqual(stats['tokens'], len(WORDS))
+
+    def test_batch(self):
+        pending = [self.service.submit(make_document(i)) for i in range(5)]
+        responses = [result.get(10) for result in pending]
+        self.assertEqual([response['id'] for response in responses], list(range(5)))
+        self.assertTrue(all(response == dict(responses[0], id=i) for i, response in enumerate(responses)))
+
+    def test_timeout(self):
+        classifier = SlowClassifier()
+        slow_service = service.ResolutionService(multeast, classifier)
+        try:
+            response = slow_service.resolve(make_document('slow'), timeout=0.05)
+            self.assertEqual(response['id'], 'slow')
+            self.assertIn('error', response)
+        finally:
+            classifier.release.set()
+
+    def test_serve_stdio(self):
+        requests = [json.dumps(make_document(1)), '[1, 2]', 'not json', json.dumps({'id': 2, 'tokens': None}),
+                    json.dumps({'command': 'stats'}), json.dumps(make_document(3))]
+        out_file = io.StringIO()
+        service.serve_stdio(self.service, io.StringIO('\n'.join(requests) + '\n'), out_file, timeout=10)
+
+        responses = [json.loads(line) for line in out_file.getvalue().splitlines()]
+        self.assertEqual(len(responses), len(requests))
+        self.assertEqual(responses[0]['id'], 1)
+        self.assertNotIn('error', responses[0])
+        self.assertIn('error', responses[1])
+        self.assertIn('error', responses[2])
+        self.assertEqual(responses[3]['id'], 2)
+        self.assertIn('error', responses[3])
+        self.assertIn('documents', responses[4])
+        self.assertNotIn('error', responses[5])
+
+
+class LoadClassifierTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_saved_classifier(self):
+        persistence.save_model(mentionpair.MentionPairClassifier(), self.tmp_dir)
+        self.assertIsInstance(service.load_classifier(model=self.tmp_dir), mentionpair.MentionPairClassifier)
+
+    def test_saved_estimator(self):
+        persistence.save_model({'coef_': [1.0, 2.0]}, self.tmp_dir)
+        with self.assertRaises(ValueError):
+            service.load_classifier(model=self.tmp_dir)
+
+    def test_classifier_by_name(self):
+        classifier = service.load_classifier('anaphoralib.experiments.mentionpair:MentionPairClassifier')
+        self.assertIsInstance(classifier, mentionpair.MentionPairClassifier)
+        with self.assertRaises(ValueError):
+            service.load_classifier('collections:OrderedDict')
+
+
+if __name__ == '__main__':
+    unittest.main()
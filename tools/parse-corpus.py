@@ -3,12 +3,16 @@
 
 import codecs
 import argparse
+import hashlib
 import logging
+import os
+import shutil
 import subprocess
 import shlex
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 
-tmp_inp_file = 'tmp_inp_file.txt'
-tmp_out_file = 'tmp_out_file.txt'
 malt_template = 'java -jar {malt_name} -c {model_name} -i {inp_file} -o {out_file} -m parse'
 
 # For now we will use the model trained on the same tags. But in the future we may need this
@@ -22,89 +26,259 @@ def convert_gram(gram):
     return gram
 
 
-def parse_document(malt_command, doc_id, lines):
-    logging.info('Parsing document {}...'.format(doc_id))
-    with codecs.open(tmp_inp_file, 'w', encoding='utf-8') as out_file:
-        for i, line in enumerate(lines):
-            out_file.write(u'{n}\t{wform}\t{lemma}\t{POS}\t{POS}\t{gram}\n'.format(n=i,
-                                                                                   wform=line['token'],
-                                                                                   lemma=line['lemma'],
-                                                                                   POS=convert_pos(line['gram'][0]),
-                                                                                   gram=convert_gram(line['gram'])))
-            if line['gram'] == 'SENT':
-                out_file.write('\n')
-    malt_output = subprocess.check_output(malt_command, stderr=subprocess.STDOUT)
-    logging.debug(malt_output)
-    logging.info('done!')
+def write_malt_input(out_file, lines):
+    """Writes a document in the MaltParser input format, the document always ends with a sentence break"""
+    for i, line in enumerate(lines):
+        out_file.write(u'{n}\t{wform}\t{lemma}\t{POS}\t{POS}\t{gram}\n'.format(n=i,
+                                                                               wform=line['token'],
+                                                                               lemma=line['lemma'],
+                                                                               POS=convert_pos(line['gram'][0]),
+                                                                               gram=convert_gram(line['gram'])))
+        if line['gram'] == 'SENT':
+            out_file.write('\n')
+    if lines and lines[-1]['gram'] != 'SENT':
+        out_file.write('\n')
+
 
+def read_malt_output(inp_file, docs_lengths):
+    """
+    Splits the MaltParser output for several documents back into documents
+    :param docs_lengths: numbers of tokens in documents
+    :return: a list of (head, rel) tuples for each document, heads are token indices within a document
+    """
+    results = [[] for _ in docs_lengths]
+    i_doc = 0
     cur_word_offset = 0
     n_words_in_sent = 0
-    results = []
-    with codecs.open(tmp_out_file, encoding='utf-8') as inp_file:
-        for line in inp_file:
-            line = line.strip('\r\n')
-
-            if not line:
-                cur_word_offset += n_words_in_sent
-                n_words_in_sent = 0
-                continue
-            fields = line.split('\t')
-            head = str(int(fields[-4]) + cur_word_offset) if fields[-4] != '0' else '0'
-            rel = fields[-3]
-            n_words_in_sent += 1
-
-            results.append((head, rel))
+
+    for line in inp_file:
+        line = line.strip('\r\n')
+
+        if not line:
+            cur_word_offset += n_words_in_sent
+            n_words_in_sent = 0
+            continue
+
+        while i_doc < len(docs_lengths) - 1 and len(results[i_doc]) == docs_lengths[i_doc]:
+            # documents are separated by sentence breaks, so a new document starts with a new sentence
+            i_doc += 1
+            cur_word_offset = 0
+
+        fields = line.split('\t')
+        head = str(int(fields[-4]) + cur_word_offset) if fields[-4] != '0' else '0'
+        rel = fields[-3]
+        n_words_in_sent += 1
+
+        results[i_doc].append((head, rel))
+
+    return results
+
+
+def parse_documents(malt_args, docs):
+    """
+    Parses a batch of documents with a single MaltParser run, temporary files are created in a private directory
+    :param malt_args: a dict with malt_name and model_name
+    :param docs: a list of tuples (doc_id, lines)
+    :return: a list of parses of documents (lists of (head, rel) tuples)
+    """
+    logging.info('Parsing documents {}-{}...'.format(docs[0][0], docs[-1][0]))
+    tmp_dir = tempfile.mkdtemp(prefix='parse_corpus_')
+    try:
+        tmp_inp_file = os.path.join(tmp_dir, 'inp.txt')
+        tmp_out_file = os.path.join(tmp_dir, 'out.txt')
+
+        with codecs.open(tmp_inp_file, 'w', encoding='utf-8') as out_file:
+            for doc_id, lines in docs:
+                write_malt_input(out_file, lines)
+
+        malt_command = shlex.split(malt_template.format(inp_file=tmp_inp_file, out_file=tmp_out_file, **malt_args))
+        malt_output = subprocess.check_output(malt_command, stderr=subprocess.STDOUT)
+        logging.debug(malt_output)
+
+        with codecs.open(tmp_out_file, encoding='utf-8') as inp_file:
+            results = read_malt_output(inp_file, [len(lines) for doc_id, lines in docs])
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    for (doc_id, lines), parse in zip(docs, results):
+        if len(parse) != len(lines):
+            raise ValueError('MaltParser returned {} tokens instead of {} for document {}'.format(len(parse),
+                                                                                                 len(lines),
+                                                                                                 doc_id))
+    logging.info('done!')
+    return results
+
+
+class ParseCache(object):
+    """
+    Stores parses of documents on disk. A document is identified by a hash of its tokens, lemmas and tags
+    and of the parser model, so a document is parsed again only if it or the model changes
+    """
+    def __init__(self, path, model_path):
+        self.path = path
+        self.model_hash = file_hash(model_path)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def document_key(self, lines):
+        doc_hash = hashlib.sha1(self.model_hash.encode('utf-8'))
+        for line in lines:
+            doc_hash.update(u'{}\t{}\t{}\n'.format(line['token'], line['lemma'], line['gram']).encode('utf-8'))
+        return doc_hash.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key + '.txt')
+
+    def get(self, lines):
+        """Returns a parse of a document (a list of (head, rel) tuples) or None if it is not in the cache"""
+        filename = self._filename(self.document_key(lines))
+        parse = None
+        if os.path.exists(filename):
+            with codecs.open(filename, encoding='utf-8') as inp_file:
+                parse = [tuple(line.strip('\r\n').split('\t')) for line in inp_file]
+            if len(parse) != len(lines):
+                parse = None
+
+        with self.lock:
+            if parse is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return parse
+
+    def put(self, lines, parse):
+        filename = self._filename(self.document_key(lines))
+        if not os.path.exists(os.path.dirname(filename)):
+            try:
+                os.makedirs(os.path.dirname(filename))
+            except OSError:  # created by another worker
+                pass
+
+        # the file is renamed only when it is complete, so readers never see a partial parse
+        tmp_filename = '{}.{}.tmp'.format(filename, threading.current_thread().ident)
+        with codecs.open(tmp_filename, 'w', encoding='utf-8') as out_file:
+            out_file.write(u''.join(u'{}\t{}\n'.format(head, rel) for head, rel in parse))
+        os.rename(tmp_filename, filename)
+
+
+def file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as inp_file:
+        for block in iter(lambda: inp_file.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def parse_documents_cached(malt_args, docs, cache=None):
+    """The same as parse_documents, but only documents missing in a cache are parsed"""
+    if cache is None:
+        return parse_documents(malt_args, docs)
+
+    results = [cache.get(lines) for doc_id, lines in docs]
+    missing = [i for i, parse in enumerate(results) if parse is None]
+    if missing:
+        for i, parse in zip(missing, parse_documents(malt_args, [docs[i] for i in missing])):
+            cache.put(docs[i][1], parse)
+            results[i] = parse
+    logging.debug('Parse cache: {} of {} documents found'.format(len(docs) - len(missing), len(docs)))
 
     return results
 
 
+def iter_documents(inp_file, fields):
+    cur_doc = None
+    lines = []
+
+    for line in inp_file:
+        line = line.strip('\r\n')
+        if not line:
+            continue
+        values = {pair[0]: pair[1] for pair in zip(fields, line.split('\t'))}
+        if cur_doc != values['doc_id']:
+            if lines:
+                yield cur_doc, lines
+
+            # new document
+            cur_doc = values['doc_id']
+            lines = []
+
+        lines.append(values)
+
+    if lines:
+        yield cur_doc, lines
+
+
+def iter_batches(docs, batch_size):
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-m', '--model', help='a path to the MaltParser model file', required=True)
     parser.add_argument('-j', '--jar', help='a path to the MaltParser jar executable', required=True)
     parser.add_argument('texts', help='CoNLL-like file with tokenized RuCoref corpus')
     parser.add_argument('output', help='initial file with dependency parsing information')
+    parser.add_argument('-b', '--batch-size', help='number of documents parsed by one MaltParser run',
+                        type=int, default=50)
+    parser.add_argument('-n', '--workers', help='number of MaltParser runs in parallel', type=int, default=1)
+    parser.add_argument('-c', '--cache', help='a directory for caching parses of documents')
     parser.add_argument('-v', help='More output', dest='verbose', action='store_true')
 
     args = parser.parse_args()
 
     logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.DEBUG if args.verbose else logging.INFO)
 
-    cur_doc = None
-    lines = []
-
-    global_out_file = codecs.open(args.output, 'w', encoding='utf-8')
-    malt_command = malt_template.format(malt_name=args.jar,
-                                        model_name=args.model,
-                                        inp_file=tmp_inp_file,
-                                        out_file=tmp_out_file)
-    malt_command = shlex.split(malt_command)
+    malt_args = {'malt_name': args.jar, 'model_name': args.model}
+    cache = ParseCache(args.cache, args.model) if args.cache else None
 
-    with codecs.open(args.texts, encoding='utf-8') as inp_file:
+    with codecs.open(args.texts, encoding='utf-8') as inp_file, \
+            codecs.open(args.output, 'w', encoding='utf-8') as global_out_file:
         fields = inp_file.readline().strip('\n\r').split('\t')
         concatenated_output = lambda lines, parsed_output: (
             '\t'.join([line[field] for field in fields] + list(parsed_output[i])) for i, line in enumerate(lines))
 
         global_out_file.write(u'\t'.join(fields) + '\thead\trel\n')
-        for line in inp_file:
-            line = line.strip('\r\n')
-            if not line:
-                continue
-            values = {pair[0]: pair[1] for pair in zip(fields, line.split('\t'))}
-            if cur_doc != values['doc_id']:
-                if lines:
-                    global_out_file.write('\n'.join(concatenated_output(lines,
-                                                                        parse_document(malt_command, cur_doc, lines))))
-                    global_out_file.write('\n')
-
-                # new document
-                out_file = codecs.open(tmp_inp_file, 'w', encoding='utf-8')
-                cur_doc = values['doc_id']
-                lines = []
-
-            lines.append(values)
-
-        if lines:
-            parses = parse_document(malt_command, cur_doc, lines)
-            global_out_file.write('\n'.join(concatenated_output(lines,
-                                                                parses)))
+
+        def parse_batch(batch):
+            return batch, parse_documents_cached(malt_args, batch, cache)
+
+        # imap reads its input as fast as it can, so batches are read from the file only when one of
+        # the previous batches has been written: no more than two batches per worker are in memory
+        in_flight = threading.Semaphore(args.workers * 2)
+        stopped = threading.Event()
+
+        def read_batches():
+            for batch in iter_batches(iter_documents(inp_file, fields), args.batch_size):
+                in_flight.acquire()
+                if stopped.is_set():
+                    return
+                yield batch
+
+        pool = ThreadPool(args.workers)
+        try:
+            first_doc = True
+            # imap keeps the order of batches, so documents are written in the order of the input file
+            for batch, parses in pool.imap(parse_batch, read_batches()):
+                for (doc_id, lines), parse in zip(batch, parses):
+                    if not first_doc:
+                        global_out_file.write('\n')
+                    global_out_file.write('\n'.join(concatenated_output(lines, parse)))
+                    first_doc = False
+                in_flight.release()
+        finally:
+            # wakes up the reader if it waits for a free slot after an error
+            stopped.set()
+            in_flight.release()
+            pool.close()
+            pool.join()
+
+    if cache is not None:
+        logging.info('Parse cache: {} hits, {} misses'.format(cache.hits, cache.misses))
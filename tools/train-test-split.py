@@ -2,27 +2,148 @@
 # -!- coding: utf-8 -!-
 
 import argparse
+import collections
 import logging
-import sys
+import math
+import random
 import re
 import codecs
 
-from sklearn import cross_validation
 
-# temporary measure while there is no package installation
-sys.path.append('/media/max/Extension/Projects/Coreference/rucoref')
+def document_statistics(filename, column=None):
+    """
+    Streams a CoNLL-like file and counts lines of each document or, if column is provided,
+    distinct values of this column in each document (e.g. chains in a GS file)
+    :return: an OrderedDict mapping doc_id to a count
+    """
+    counts = collections.OrderedDict()
+    values = collections.defaultdict(set)
+
+    with codecs.open(filename, encoding='utf-8') as inp_file:
+        fields = inp_file.readline().strip('\r\n').split('\t')
+        doc_id_pos = fields.index('doc_id')
+        column_pos = fields.index(column) if column else None
+        for line in inp_file:
+            if not line.strip('\r\n'):
+                continue
+            line_values = line.split('\t')
+            doc_id = int(line_values[doc_id_pos])
+            if column_pos is None:
+                counts[doc_id] = counts.get(doc_id, 0) + 1
+            else:
+                counts.setdefault(doc_id, 0)
+                values[doc_id].add(line_values[column_pos])
+
+    if column_pos is not None:
+        for doc_id in counts:
+            counts[doc_id] = len(values[doc_id])
+
+    return counts
+
+
+def index_documents(texts_filename, gs_filename=None):
+    """
+    Collects statistics of documents needed for splitting
+    :param gs_filename: a GS file, needed only for numbers of chains
+    :return: an OrderedDict mapping doc_id to a dict with a number of tokens and a number of chains
+    """
+    docs = collections.OrderedDict((doc_id, {'length': length, 'chains': 0})
+                                   for doc_id, length in document_statistics(texts_filename).items())
+
+    if gs_filename is not None:
+        for doc_id, n_chains in document_statistics(gs_filename, 'chain_id').items():
+            if doc_id in docs:
+                docs[doc_id]['chains'] = n_chains
+
+    return docs
+
+
+def assign_folds(docs, n_folds, random_state=None, stratify=None):
+    """
+    Assigns each document to a fold (the fold where it is in the test set)
+    :param stratify: None, 'length' or 'chains': if provided, documents are sorted by this statistic and
+    every n_folds consecutive documents are spread over different folds, so folds have similar distributions
+    :return: a dict mapping doc_id to a fold
+    """
+    rnd = random.Random(random_state)
+    doc_ids = list(docs)
+    rnd.shuffle(doc_ids)
+
+    if stratify:
+        doc_ids.sort(key=lambda doc_id: docs[doc_id][stratify])
+
+    folds = {}
+    for start in range(0, len(doc_ids), n_folds):
+        block_folds = list(range(n_folds))
+        rnd.shuffle(block_folds)
+        for doc_id, fold in zip(doc_ids[start:start + n_folds], block_folds):
+            folds[doc_id] = fold
+
+    return folds
+
+
+def assign_test_set(docs, test_size, random_state=None):
+    """Chooses test documents of a single train/test split: test documents get fold 0, train ones fold -1"""
+    doc_ids = list(docs)
+    random.Random(random_state).shuffle(doc_ids)
+    n_test = int(math.ceil(test_size * len(doc_ids)))
+    return {doc_id: 0 if i < n_test else -1 for i, doc_id in enumerate(doc_ids)}
+
+
+def split_lines(lines, folds, train_filenames, test_filenames):
+    """
+    Writes lines of every document to the test file of its fold and to train files of all other folds
+    in a single pass. Documents without a fold (e.g. GS documents missing in texts) are never used
+    for training: they go to all test files
+    :param lines: an iterable of lines of a CoNLL-like file starting with its header
+    """
+    out_files_train = [codecs.open(filename, 'w', encoding='utf-8') for filename in train_filenames]
+    out_files_test = [codecs.open(filename, 'w', encoding='utf-8') for filename in test_filenames]
+    docs_out_files = {}
+
+    try:
+        lines = iter(lines)
+        # writing headers
+        line = next(lines)
+        for out_file in out_files_train + out_files_test:
+            out_file.write(line)
+        doc_id_pos = line.strip('\r\n').split('\t').index('doc_id')
+
+        for line in lines:
+            if not line.strip('\r\n'):
+                continue
+            doc_id = int(line.split('\t', doc_id_pos + 1)[doc_id_pos])
+            if doc_id not in docs_out_files:
+                fold = folds.get(doc_id)
+                if fold is None:
+                    docs_out_files[doc_id] = out_files_test
+                else:
+                    docs_out_files[doc_id] = [out_file for i, out_file in enumerate(out_files_train) if i != fold] + \
+                                             [out_file for i, out_file in enumerate(out_files_test) if i == fold]
+            for out_file in docs_out_files[doc_id]:
+                out_file.write(line)
+    finally:
+        for out_file in out_files_train + out_files_test:
+            out_file.close()
 
-from anaphoralib.corpora import rueval
-from anaphoralib.tagsets import multeast
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(epilog='Documents are split by texts: GS documents that are missing in texts '
+                                            'are never used for training, they are written to all test files')
     parser.add_argument('texts', help='CoNLL-like file with tokenized RuCoref corpus')
     parser.add_argument('gs', help='CoNLL-like file with RuCoref annotations')
     parser.add_argument('--test-size', '-s',
                         default=0.3,
                         help='the proportion of a test subcorpus',
                         type=float)
+    parser.add_argument('--folds', '-k',
+                        help='number of folds for cross-validation; if provided, train and test files are '
+                             'written for every fold instead of a single train/test split',
+                        type=int,
+                        default=None)
+    parser.add_argument('--stratify', help='make folds similar in document lengths or numbers of chains',
+                        choices=('length', 'chains'),
+                        default=None)
     parser.add_argument('--random-state', help='random state for the pseudo-random number generation',
                         type=int,
                         default=None)
@@ -34,52 +155,36 @@ if __name__ == '__main__':
 
     logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.DEBUG if args.verbose else logging.INFO)
 
-    rucoref = rueval.RuCorefCorpus(multeast, rueval)
-    logging.info(u'Loading RuCoref texts from {}, GS from {}'.format(args.texts, args.gs))
-    logging.debug('Loading texts...')
-    rucoref.load_texts(args.texts)
-    logging.debug('Loading GS...')
-    rucoref.load_gs(args.gs)
-
-    doc_split = cross_validation.ShuffleSplit(len(rucoref.doc_ids),
-                                              n_iter=1,
-                                              test_size=args.test_size,
-                                              random_state=args.random_state)
-    train_set = [rucoref.doc_ids[i] for i in sorted(list(doc_split)[0][0])]
-    test_set = [rucoref.doc_ids[i] for i in sorted(list(doc_split)[0][1])]
-
-    logging.debug('Train set ({}): {}'.format(len(train_set), ', '.join(str(i) for i in train_set)))
-    logging.debug('Test set ({}): {}'.format(len(test_set), ', '.join(str(i) for i in test_set)))
+    # folds depend on statistics of all documents, so files are streamed twice: the first pass collects
+    # only statistics (the GS file is read in it only if numbers of chains are needed), the second one
+    # writes lines to the outputs in their original order
+    logging.info(u'Indexing RuCoref texts from {}'.format(args.texts))
+    gs_filename = None
+    if args.stratify == 'chains':
+        logging.info(u'Indexing RuCoref GS from {}'.format(args.gs))
+        gs_filename = args.gs
+    docs = index_documents(args.texts, gs_filename)
 
     rx_txt = re.compile('\\.txt$')
 
-    end_suffix_test = '.test.txt'
-    end_suffix_train = '.train.txt'
-
-    out_texts_train = rx_txt.sub(end_suffix_train, args.texts)
-    out_gs_train = rx_txt.sub(end_suffix_train, args.gs)
-
-    out_texts_test = rx_txt.sub(end_suffix_test, args.texts)
-    out_gs_test = rx_txt.sub(end_suffix_test, args.gs)
-
-    filenames = (('texts', args.texts, out_texts_train, out_texts_test),
-                 ('GS', args.gs, out_gs_train, out_gs_test))
-
-    for name, inp_filename, out_filename_train, out_filename_test in filenames:
+    if args.folds:
+        if args.folds < 2:
+            parser.error('number of folds should be at least 2')
+        folds = assign_folds(docs, args.folds, args.random_state, args.stratify)
+        suffixes_train = ['.fold{}.train.txt'.format(i) for i in range(args.folds)]
+        suffixes_test = ['.fold{}.test.txt'.format(i) for i in range(args.folds)]
+    else:
+        folds = assign_test_set(docs, args.test_size, args.random_state)
+        suffixes_train = ['.train.txt']
+        suffixes_test = ['.test.txt']
+
+    for i in range(len(suffixes_test)):
+        test_set = sorted(doc_id for doc_id in docs if folds[doc_id] == i)
+        logging.debug('Fold {}, test set ({}): {}'.format(i, len(test_set), ', '.join(str(d) for d in test_set)))
+
+    for name, inp_filename in (('texts', args.texts), ('GS', args.gs)):
         logging.info('Saving train and test {}'.format(name))
-
-        out_file_train = codecs.open(out_filename_train, 'w', encoding='utf-8')
-        out_file_test = codecs.open(out_filename_test, 'w', encoding='utf-8')
-
         with codecs.open(inp_filename, encoding='utf-8') as inp_file:
-            # writing headers
-            line = inp_file.readline()
-            out_file_test.write(line)
-            out_file_train.write(line)
-
-            for line in inp_file:
-                doc_id = int(line.split('\t')[0])
-                if doc_id in train_set:
-                    out_file_train.write(line)
-                else:
-                    out_file_test.write(line)
+            split_lines(inp_file, folds,
+                        [rx_txt.sub(suffix, inp_filename) for suffix in suffixes_train],
+                        [rx_txt.sub(suffix, inp_filename) for suffix in suffixes_test])